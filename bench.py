@@ -0,0 +1,387 @@
+# Microbenchmarks for the decoding/encoding hot paths, fed with the captures in sniffer.py and captures/.
+# Runs under CPython and the MicroPython unix port alike:
+#
+#     python3 bench.py -o before.json
+#     micropython bench.py -o before_mpy.json
+#     python3 bench.py -o after.json get_message show_msg
+#     python3 bench.py compare before.json after.json
+#
+# Every benchmark runs a batch of operations in a loop; the loop count is picked so that one sample
+# takes at least `min_time` seconds, and the sample is taken `repeat` times.
+# Results are in microseconds per operation; compare medians (or minimums) between commits.
+
+import sys
+import gc
+import json
+
+import pdstacc
+from pdstacc import PDStacc, PDMessage, myhex, mybin
+from capture import ReplaySource
+from compat import ticks_us, ticks_diff, Null
+
+base_dir = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+
+########################
+#
+# Test data
+#
+########################
+
+def load_packets(path=None):
+    # the packetsN = [...] lists from sniffer.py, read as text, so that none of sniffer.py has to run
+    if path is None:
+        path = base_dir + "/sniffer.py"
+    packets = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("packets") and line[7:8].isdigit():
+                packets.extend(json.loads(line.split(" = ", 1)[1]))
+    return packets
+
+class NullFUSB():
+    # takes in whatever the stack sends, for benchmarking the message building code
+    def send(self, message):
+        pass
+
+    def drop_rxb(self):
+        pass
+
+def null_print(*args, **kwargs):
+    pass
+
+class Quiet():
+    # stops a module from printing, by shadowing its `sys` and `print`;
+    # works on MicroPython too, where sys.stdout can't be replaced
+    def __init__(self, module):
+        self.module = module
+
+    def __enter__(self):
+        self.sys = self.module.sys
+        self.module.sys = self
+        self.module.print = null_print
+        return self
+
+    def __exit__(self, *args):
+        self.module.sys = self.sys
+        del self.module.print
+
+    stdout = Null()
+
+def parse_all(stacc, source):
+    messages = []
+    source.rewind()
+    while not source.done():
+        d = stacc.get_message(source.get_rxb)
+        if d is not None:
+            messages.append(d)
+    return messages
+
+class Data():
+    # everything the benchmarks work on, prepared once
+    def __init__(self):
+        self.packets = load_packets()
+        self.source = ReplaySource(self.packets)
+        self.stacc = PDStacc(NullFUSB(), history=0)
+        with Quiet(pdstacc):
+            self.messages = parse_all(self.stacc, self.source)
+        # raw fields, for creating fresh (not yet decoded) messages
+        self.raw = [(d.h, d.b1, d.b0, d.d if d.dc else None, d.crc_ok) for d in self.messages]
+        self.caps_pdos = []
+        self.vdms = []
+        for d in self.messages:
+            if d.k == PDStacc.source_caps_key:
+                for i in range(d.dc):
+                    self.caps_pdos.append(bytes(d.d[i*4:i*4+4]))
+            elif d.k == PDStacc.vdm_key:
+                self.vdms.append(d)
+        self.payloads = [bytes(packet) for packet in self.packets]
+
+########################
+#
+# Benchmarks
+#
+########################
+
+# every benchmark takes the Data instance and returns (batch function, operations per batch)
+
+def bench_get_message(data):
+    stacc = data.stacc
+    source = data.source
+    def run():
+        source.rewind()
+        while not source.done():
+            stacc.get_message(source.get_rxb)
+    return run, len(data.messages)
+
+def bench_show_msg(data):
+    stacc = data.stacc
+    raw = data.raw
+    def run():
+        # fresh messages every time, so that the on-demand decoding gets measured too
+        stacc.caps_cache.clear()
+        for h, b1, b0, d, crc_ok in raw:
+            m = PDMessage(h, b1, b0, stacc)
+            if d is not None:
+                m.d = d
+            m.crc_ok = crc_ok
+            stacc.show_msg(m)
+    return run, len(raw)
+
+def bench_parse_capability_pdo(data):
+    parse = data.stacc.parse_capability_pdo
+    pdos = data.caps_pdos
+    def run():
+        for pdo in pdos:
+            parse(pdo)
+    return run, len(pdos)
+
+def bench_create_pdo(data):
+    create = data.stacc.create_pdo
+    args = [(5000, 3000, 0, 8), (9000, 3000, 0, 0), (12000, 3000, 0, 0), (15000, 3000, 0, 0), (20000, 5000, 0, 0)]
+    def run():
+        for a in args:
+            create('fixed', *a)
+    return run, len(args)
+
+def bench_request_fixed_pdo(data):
+    request = data.stacc.request_fixed_pdo
+    args = [(0, 3000, 3000), (1, 3000, 3000), (2, 2250, 3000), (3, 5000, 5000)]
+    def run():
+        for a in args:
+            request(*a)
+    return run, len(args)
+
+def bench_create_vdm_data(data):
+    create = data.stacc.create_vdm_data
+    replies = []
+    for (svid, command), d in data.stacc.vdm_reply_data.items():
+        replies.append(({"vdm_s": 1, "vdm_sv": svid, "vdm_c": command, "vdm_ct": 1}, d))
+    def run():
+        for rd, d in replies:
+            create(rd, d)
+    return run, len(replies)
+
+def bench_parse_vdm(data):
+    parse = data.stacc.parse_vdm
+    vdms = data.vdms
+    def run():
+        for d in vdms:
+            parse(d)
+    return run, len(vdms)
+
+def bench_myhex(data):
+    payloads = data.payloads
+    def run():
+        for p in payloads:
+            myhex(p)
+    return run, len(payloads)
+
+def bench_mybin(data):
+    payloads = data.payloads
+    def run():
+        for p in payloads:
+            mybin(p)
+    return run, len(payloads)
+
+def bench_postfactum_readout(data):
+    # reads the capture back in the same chunks that get_message() asks for
+    stdout = sys.stdout
+    try:
+        sys.stdout = Null()
+    except AttributeError:
+        pass # MicroPython, the replay is going to be printed
+    try:
+        import sniffer
+    finally:
+        try:
+            sys.stdout = stdout
+        except AttributeError:
+            pass
+    lengths = []
+    source = ReplaySource(data.packets)
+    def record(l=80):
+        lengths.append(l)
+        return source.get_rxb(l)
+    with Quiet(pdstacc):
+        while not source.done():
+            data.stacc.get_message(record)
+    sniffer.source = source
+    readout = sniffer.postfactum_readout
+    def run():
+        source.rewind()
+        for l in lengths:
+            readout(l)
+    return run, len(lengths)
+
+def bench_trace(data):
+    # captures/trace.py on the sigrok I2C export, from annotation lines to printable accesses
+    # it's not a package, and "import trace" would get the standard library one
+    trace = {"__name__": "captures_trace"}
+    with open(base_dir + "/captures/trace.py") as f:
+        exec(f.read(), trace)
+    assemble = trace["assemble"]
+    decode = trace["decode"]
+    format_access = trace["format_access"]
+    lines = list(trace["read_lines"]([base_dir + "/captures/dec.txt"]))
+    accesses = len(list(decode(assemble(lines))))
+    def run():
+        for access in decode(assemble(lines)):
+            format_access(*access)
+    return run, accesses
+
+benchmarks = [
+    ("get_message", bench_get_message),
+    ("show_msg", bench_show_msg),
+    ("parse_capability_pdo", bench_parse_capability_pdo),
+    ("create_pdo", bench_create_pdo),
+    ("request_fixed_pdo", bench_request_fixed_pdo),
+    ("create_vdm_data", bench_create_vdm_data),
+    ("parse_vdm", bench_parse_vdm),
+    ("myhex", bench_myhex),
+    ("mybin", bench_mybin),
+    ("sniffer.postfactum_readout", bench_postfactum_readout),
+    ("trace", bench_trace),
+]
+
+########################
+#
+# Running and reporting
+#
+########################
+
+def measure(run, loops):
+    gc.collect()
+    start = ticks_us()
+    for i in range(loops):
+        run()
+    return ticks_diff(ticks_us(), start)
+
+def calibrate(run, min_time):
+    # doubles the loop count until one sample takes at least min_time
+    loops = 1
+    while True:
+        t = measure(run, loops)
+        if t >= min_time * 1000000 or loops >= 1 << 20:
+            return loops
+        loops *= 2
+
+def stats(values):
+    values = sorted(values)
+    return {"min": values[0], "median": values[len(values)//2], "mean": sum(values) / len(values), "max": values[-1]}
+
+def git_commit():
+    # current commit, read straight from .git so that it works without git (or subprocess) around
+    try:
+        with open(base_dir + "/.git/HEAD") as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return head
+        ref = head[5:]
+        try:
+            with open(base_dir + "/.git/" + ref) as f:
+                return f.read().strip()
+        except OSError:
+            with open(base_dir + "/.git/packed-refs") as f:
+                for line in f:
+                    if line.strip().endswith(" " + ref):
+                        return line.split(" ", 1)[0]
+    except OSError:
+        pass
+    return None
+
+def run_benchmarks(names=None, repeat=5, min_time=0.1, out=None):
+    data = Data()
+    results = {}
+    skipped = {}
+    for name, setup in benchmarks:
+        if names and name not in names:
+            continue
+        # one benchmark failing shouldn't take the rest with it: e.g. trace.py needs argparse,
+        # which the MicroPython unix port doesn't have, and sniffer.py needs the machine module
+        try:
+            run, ops = setup(data)
+            with Quiet(pdstacc):
+                loops = calibrate(run, min_time)
+                samples = [measure(run, loops) / (loops * ops) for i in range(repeat)]
+        except Exception as e:
+            skipped[name] = "{}: {}".format(type(e).__name__, e)
+            continue
+        results[name] = {"ops": ops, "loops": loops, "us_per_op": stats(samples)}
+        if out is not None:
+            out.write("{:28} {:10.3f} us/op (min {:.3f}, {} ops x {} loops)\n".format(
+                name, results[name]["us_per_op"]["median"], results[name]["us_per_op"]["min"], ops, loops))
+    for name, reason in skipped.items():
+        if out is not None:
+            out.write("{:28} skipped: {}\n".format(name, reason))
+    return {
+        "implementation": sys.implementation.name,
+        "version": ".".join([str(v) for v in sys.implementation.version[:3]]),
+        "platform": sys.platform,
+        "commit": git_commit(),
+        "repeat": repeat,
+        "min_time": min_time,
+        "results": results,
+        "skipped": skipped,
+    }
+
+def compare(old, new, threshold=0.05):
+    # median time ratio for every benchmark present in both result files
+    sys.stdout.write("{:28} {:>10} {:>10} {:>8}\n".format("", "old us/op", "new us/op", "new/old"))
+    for name, r in new["results"].items():
+        if name not in old["results"]:
+            continue
+        a = old["results"][name]["us_per_op"]["median"]
+        b = r["us_per_op"]["median"]
+        ratio = b / a
+        note = ""
+        if ratio < 1 - threshold:
+            note = " faster"
+        elif ratio > 1 + threshold:
+            note = " slower"
+        sys.stdout.write("{:28} {:10.3f} {:10.3f} {:8.3f}{}\n".format(name, a, b, ratio, note))
+
+usage = """usage: bench.py [-o results.json] [-n repeat] [-t min_time] [benchmark ...]
+       bench.py compare old.json new.json"""
+
+def main(argv):
+    # no argparse on MicroPython
+    if argv and argv[0] == "compare":
+        if len(argv) != 3:
+            print(usage)
+            return
+        with open(argv[1]) as f:
+            old = json.load(f)
+        with open(argv[2]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+    output = None
+    repeat = 5
+    min_time = 0.1
+    names = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg in ("-h", "--help"):
+            print(usage)
+            return
+        elif arg == "-o":
+            output = argv.pop(0)
+        elif arg == "-n":
+            repeat = int(argv.pop(0))
+        elif arg == "-t":
+            min_time = float(argv.pop(0))
+        else:
+            names.append(arg)
+    known = [name for name, setup in benchmarks]
+    for name in names:
+        if name not in known:
+            print("unknown benchmark {}, pick from: {}".format(name, " ".join(known)))
+            return
+    results = run_benchmarks(names, repeat, min_time, out=sys.stdout)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Decodes USB-PD traffic from CC line samples captured with a logic analyzer,
+# straight from the BMC signal instead of going through the FUSB302 FIFO.
+# Messages get timestamps from the capture, and there's no 80-byte FIFO to overflow.
+# Needs NumPy:
+#
+#     python3 bmcdecode.py --cc D2 capture.sr
+#
+# Edges -> BMC bits -> 5b symbols -> ordered set, bytes and CRC, all done with array operations;
+# Python only loops once per packet. Decoded packets are turned into FIFO-style bytes
+# and parsed with PDStacc.get_message()/show_msg(), same as sniffer.py does.
+
+import argparse
+import binascii
+import sys
+
+import numpy as np
+
+from capture import ReplaySource
+from pdstacc import PDStacc, myhex
+from sigrok import load_sr
+
+# USB-PD BMC bitrate is 300kbps +-10%
+BITRATE = 300000
+
+########################
+#
+# 4b5b
+#
+########################
+
+# K-codes, as 5b symbol values. first bit on the wire is bit 0
+SYNC_1 = 0x18
+SYNC_2 = 0x11
+SYNC_3 = 0x06
+RST_1 = 0x07
+RST_2 = 0x19
+EOP = 0x0d
+
+# 5b symbol -> 4b value, or -1 for K-codes and invalid symbols
+dec4b5b = np.full(32, -1, dtype=np.int16)
+for value, symbol in enumerate([0x1e, 0x09, 0x14, 0x15, 0x0a, 0x0b, 0x0e, 0x0f,
+                                0x12, 0x13, 0x16, 0x17, 0x1a, 0x1b, 0x1c, 0x1d]):
+    dec4b5b[symbol] = value
+
+# ordered sets, and the FUSB302 RX token each corresponds to (None if the FUSB doesn't receive it)
+ordered_sets = {
+    (SYNC_1, SYNC_1, SYNC_1, SYNC_2): ("SOP", 0xe0),
+    (SYNC_1, SYNC_1, SYNC_3, SYNC_3): ("SOP'", 0xc0),
+    (SYNC_1, SYNC_3, SYNC_1, SYNC_3): ("SOP''", None),
+    (SYNC_1, RST_2, RST_2, SYNC_3): ("SOP'_Debug", None),
+    (SYNC_1, RST_2, SYNC_3, SYNC_2): ("SOP''_Debug", None),
+    (RST_1, RST_1, RST_1, RST_2): ("Hard_Reset", None),
+    (RST_1, SYNC_1, RST_1, SYNC_3): ("Cable_Reset", None),
+}
+
+def match_ordered_set(symbols):
+    # the spec says an ordered set is recognized if at least 3 of 4 K-codes match
+    symbols = tuple(symbols)
+    for ks, name in ordered_sets.items():
+        if sum([a == b for a, b in zip(ks, symbols)]) >= 3:
+            return name
+    return None, None
+
+########################
+#
+# BMC decoding
+#
+########################
+
+def find_edges(line):
+    # sample indices where the CC line changes
+    return np.flatnonzero(np.diff(line)) + 1
+
+def split_packets(edges, samplerate, bitrate=BITRATE):
+    # packets are separated by idle line; anything longer than a few bit times counts as idle.
+    # returns a list of (first edge, last edge) index pairs into `edges`
+    ui = samplerate / bitrate
+    gaps = np.flatnonzero(np.diff(edges) > 3*ui)
+    starts = np.concatenate(([0], gaps + 1))
+    ends = np.concatenate((gaps, [len(edges) - 1]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def bmc_bits(intervals, samplerate, bitrate=BITRATE):
+    # a 0 is a full bit time between edges, a 1 is two half bit times
+    short = intervals < 0.75 * samplerate / bitrate
+    idx = np.arange(len(short))
+    # position of every short interval within its run of shorts; every second one completes a 1
+    run_start = np.maximum.accumulate(np.where(short, 0, idx + 1))
+    pos = idx - run_start
+    emit = ~short | ((pos & 1) == 1)
+    return short[emit].astype(np.uint8)
+
+def symbols_from_bits(bits):
+    # finds the start of the ordered set after the preamble and cuts the rest into 5b symbols
+    if len(bits) < 25:
+        return None
+    n = len(bits) - 4
+    windows = bits[0:n] | (bits[1:n+1] << 1) | (bits[2:n+2] << 2) | (bits[3:n+3] << 3) | (bits[4:n+4] << 4)
+    # the preamble alternates 0 and 1, so the first Sync-1 or RST-1 found is where the ordered set starts
+    candidates = np.flatnonzero((windows == SYNC_1) | (windows == RST_1))
+    if not len(candidates):
+        return None
+    return windows[candidates[0]::5]
+
+def decode_packet(symbols):
+    # returns (ordered set name, FUSB token, payload bytes including CRC, crc_ok)
+    name, token = match_ordered_set(symbols[:4].tolist())
+    if name is None or name.endswith("Reset"):
+        return name, token, b'', name is not None
+    body = symbols[4:]
+    eop = np.flatnonzero(body == EOP)
+    if len(eop):
+        body = body[:eop[0]]
+    nibbles = dec4b5b[body]
+    # a nibble that isn't valid data, or an odd number of them, means the packet is broken
+    n = len(nibbles) & ~1
+    bad = (nibbles < 0).any() or n != len(nibbles) or not len(eop)
+    nibbles = nibbles[:n].clip(0)
+    # low nibble goes first
+    payload = (nibbles[0::2] | (nibbles[1::2] << 4)).astype(np.uint8).tobytes()
+    crc_ok = not bad and len(payload) > 4 and binascii.crc32(payload[:-4]) == int.from_bytes(payload[-4:], 'little')
+    return name, token, payload, crc_ok
+
+def decode_bmc(line, samplerate, bitrate=BITRATE):
+    # yields (time in seconds, ordered set name, FUSB token, payload bytes, crc_ok) for every packet on the line
+    edges = find_edges(line)
+    intervals = np.diff(edges)
+    for start, end in split_packets(edges, samplerate, bitrate):
+        if end - start < 16:
+            continue # a glitch, or a packet that got cut off
+        bits = bmc_bits(intervals[start:end], samplerate, bitrate)
+        symbols = symbols_from_bits(bits)
+        if symbols is None:
+            continue
+        name, token, payload, crc_ok = decode_packet(symbols)
+        if name is None:
+            continue
+        yield edges[start] / samplerate, name, token, payload, crc_ok
+
+def load_bmc(path, cc="D0", bitrate=BITRATE):
+    # decodes packets straight from an .sr file, with the CC line given by probe name
+    samples, samplerate, probes = load_sr(path)
+    line = ((samples >> probes[cc]) & 1).astype(np.int8)
+    return decode_bmc(line, samplerate, bitrate)
+
+########################
+#
+# Message parsing
+#
+########################
+
+def show_packets(packets, stacc=None):
+    # prints packets the way sniffer.py does, with timestamps and CRC status
+    if stacc is None:
+        stacc = PDStacc(None, history=0)
+    for ts, name, token, payload, crc_ok in packets:
+        if token is None or not crc_ok:
+            # resets, SOP'' packets (the FUSB-style parsing only knows about SOP and SOP'),
+            # and broken packets, which aren't worth parsing
+            crc_str = "" if crc_ok else " (CRC error)"
+            sys.stdout.write("{:.6f} {}{} {}\n".format(ts, name, crc_str, myhex(payload)))
+            continue
+        sys.stdout.write("{:.6f}\n".format(ts))
+        source = ReplaySource(bytes([token]) + payload)
+        stacc.fusb = source
+        d = stacc.get_message()
+        if d is not None:
+            stacc.show_msg(d)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode USB-PD messages from CC line logic analyzer captures")
+    parser.add_argument("paths", nargs="+", help=".sr sessions")
+    parser.add_argument("--cc", default="D0", help="probe name of the CC line (default: D0)")
+    parser.add_argument("--bitrate", type=int, default=BITRATE, help="nominal BMC bitrate (default: 300000)")
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        if len(args.paths) > 1:
+            print("# {}".format(path))
+        show_packets(load_bmc(path, args.cc, args.bitrate))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+from compat import ticks_us, TICKS_PERIOD
+
+########################
+#
+# Capture file format
+#
+########################
+
+# every record is a 9-byte header followed by the raw FIFO bytes:
+# sync (0xA6), data length, CC line, timestamp (6 bytes, little-endian).
+# the timestamp is microseconds since the writer started, so it doesn't wrap around
+# like ticks_us() does every 2^30 us (~18 minutes) - 48 bits is good for about 9 years
+SYNC = 0xA6
+HEADER_LEN = 9
+TS_LEN = 6
+MAX_DATA_LEN = 255
+
+class CaptureWriter():
+    # streams capture records into anything with a write() method - a file, a UART, a socket.
+    # records are packed into one of two preallocated buffers. once a buffer fills up, the buffers
+    # are swapped and the full one is left pending; it gets written out by idle(), which the capture
+    # loop calls when the FUSB has nothing for it, so slow writes stay off the path that drains the FIFO.
+    # if the other buffer fills up before idle() got to run, record() has to write the pending one itself.
+    # memory use stays the same no matter how long the capture runs
+    def __init__(self, stream, buf_size=1024):
+        if buf_size < HEADER_LEN + MAX_DATA_LEN:
+            raise ValueError("buf_size has to fit at least one record ({} bytes)".format(HEADER_LEN + MAX_DATA_LEN))
+        self.stream = stream
+        self.bufs = (bytearray(buf_size), bytearray(buf_size))
+        self.active = 0
+        self.fill = 0
+        # length of the full buffer waiting to be written out, 0 if there's none
+        self.pending = 0
+        self.records = 0
+        self.bytes_written = 0
+        # how many times record() had to write a buffer out itself
+        self.stalls = 0
+        # ticks_us() at the last tick(), and microseconds elapsed up to it
+        self.last_ticks = None
+        self.elapsed = 0
+
+    def tick(self, ticks=None):
+        # advances the writer's clock to a ticks_us() value, returns microseconds since the first tick.
+        # every wraparound gets counted as long as this is called more often than every ~18 minutes;
+        # record() and idle() call it, so quiet lines don't lose time
+        if ticks is None:
+            ticks = ticks_us()
+        if self.last_ticks is not None:
+            self.elapsed += (ticks - self.last_ticks) & (TICKS_PERIOD - 1)
+        self.last_ticks = ticks
+        return self.elapsed
+
+    def record(self, data, cc=0, ts=None):
+        # ts is a ticks_us() value from when the data was read out, if not now
+        ts = self.tick(ts)
+        l = len(data)
+        if l > MAX_DATA_LEN:
+            l = MAX_DATA_LEN
+        pos = self.fill
+        if pos + HEADER_LEN + l > len(self.bufs[self.active]):
+            self.swap()
+            pos = 0
+        buf = self.bufs[self.active]
+        buf[pos] = SYNC
+        buf[pos+1] = l
+        buf[pos+2] = cc
+        for i in range(TS_LEN):
+            buf[pos+3+i] = (ts >> (i*8)) & 0xff
+        pos += HEADER_LEN
+        buf[pos:pos+l] = data[:l]
+        self.fill = pos + l
+        self.records += 1
+
+    def swap(self):
+        # makes the active buffer pending and starts filling the other one
+        if self.pending:
+            # idle() didn't keep up
+            self.stalls += 1
+            self.write_pending()
+        self.pending = self.fill
+        self.active ^= 1
+        self.fill = 0
+
+    def write_pending(self):
+        l = self.pending
+        if l:
+            self.stream.write(memoryview(self.bufs[self.active ^ 1])[:l])
+            self.bytes_written += l
+            self.pending = 0
+
+    def idle(self):
+        # call this from the capture loop whenever there's nothing to read:
+        # writes out a full buffer if there's one, and keeps the clock going
+        self.tick()
+        if self.pending:
+            self.write_pending()
+
+    def flush(self):
+        self.write_pending()
+        self.swap()
+        self.write_pending()
+        if hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+########################
+#
+# Capture file reading
+#
+########################
+
+def read_capture(stream, chunk_size=4096):
+    # yields (timestamp in us, CC line, data bytes) for each record in a capture.
+    # timestamps start at 0 for the first record.
+    # garbage between records (say, from a UART that started mid-record) gets skipped
+    buf = b''
+    pos = 0
+    first_ts = None
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < HEADER_LEN + MAX_DATA_LEN:
+            # pipes, sockets and UARTs return whatever they have, so short reads are normal;
+            # only an empty read means the stream has ended
+            chunk = stream.read(chunk_size)
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+            elif chunk is not None:
+                eof = True
+            # None is a non-blocking stream with no data yet
+            continue
+        if len(buf) - pos < HEADER_LEN:
+            return
+        if buf[pos] != SYNC:
+            pos += 1
+            continue
+        l = buf[pos+1]
+        if len(buf) - pos < HEADER_LEN + l:
+            return # truncated last record, only possible at the end of the stream
+        cc = buf[pos+2]
+        ts = 0
+        for i in range(TS_LEN):
+            ts |= buf[pos+3+i] << (i*8)
+        data = bytes(buf[pos+HEADER_LEN:pos+HEADER_LEN+l])
+        pos += HEADER_LEN + l
+        if first_ts is None:
+            first_ts = ts
+        yield ts - first_ts, cc, data
+
+########################
+#
+# Capture replay
+#
+########################
+
+class ReplaySource():
+    # pretends to be the FUSB FIFO, serving get_rxb() calls from captured data,
+    # so that PDStacc.get_message() can parse captures after the fact.
+    # all packets are joined into one buffer that's read through a memoryview with a cursor,
+    # so every read is O(length) and replaying a capture takes linear time
+    def __init__(self, packets):
+        # packets is either a list of captured packets (lists of ints or bytes), or one bytes-like blob
+        if isinstance(packets, (bytes, bytearray, memoryview)):
+            data = bytes(packets)
+            starts = [0]
+        else:
+            starts = []
+            chunks = []
+            l = 0
+            for packet in packets:
+                starts.append(l)
+                chunk = bytes(packet)
+                chunks.append(chunk)
+                l += len(chunk)
+            data = b''.join(chunks)
+        self.data = data
+        self.view = memoryview(data)
+        # offsets where each captured packet starts
+        self.starts = starts
+        self.pos = 0
+
+    def get_rxb(self, l=80):
+        pos = self.pos
+        end = pos + l
+        size = len(self.data)
+        if end <= size:
+            self.pos = end
+            return self.view[pos:end]
+        # buffer underflow, returning what's left with zeroes in the end, just like the FUSB does
+        self.pos = size
+        return bytes(self.view[pos:]) + bytes(end - max(pos, size))
+
+    def drop_rxb(self):
+        # get_message() calls this when it hits padding; nothing is buffered on top of the capture
+        pass
+
+    def done(self):
+        return self.pos >= len(self.data)
+
+    def packet_index(self):
+        # which captured packet the cursor is in
+        starts = self.starts
+        lo = 0
+        hi = len(starts)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if starts[mid] <= self.pos:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def skip_packet(self):
+        # moves the cursor to the start of the next captured packet, for resyncing after garbage
+        i = self.packet_index() + 1
+        self.pos = self.starts[i] if i < len(self.starts) else len(self.data)
+
+    def rewind(self):
+        self.pos = 0
+
+########################
+#
+# Retransmission filtering
+#
+########################
+
+class RetryFilter():
+    # collapses hardware retries - copies of a message (same SOP, header with its message ID, and payload)
+    # sent again because the GoodCRC didn't make it back - into one message with a retry count.
+    # messages are held back until `window` more messages have come in (or `window_us` has passed,
+    # if timestamps are given), so that all of their retries are counted by the time they come out
+    def __init__(self, window=4, window_us=None):
+        self.window = window
+        self.window_us = window_us
+        # [key, message, retries, number and timestamp of the latest copy, timestamp and CC line of the first copy]
+        # for messages still in the window
+        self.pending = []
+        self.count = 0
+        # stats
+        self.messages = 0
+        self.retries = 0
+        self.retries_by_type = {}
+
+    def key(self, d):
+        return (d.h, d.b1, d.b0, bytes(d.d) if d.dc else b'')
+
+    def push(self, d, ts=None, cc=None):
+        # returns a list of (message, retries, timestamp of the first copy, CC line of the first copy)
+        # that have left the window
+        self.count += 1
+        out = self.expire(ts)
+        key = self.key(d)
+        for entry in self.pending:
+            if entry[0] == key:
+                # the window restarts from the latest copy, so long retry chains stay together
+                entry[2] += 1
+                entry[3] = self.count
+                entry[4] = ts
+                self.retries += 1
+                name = d.tn
+                self.retries_by_type[name] = self.retries_by_type.get(name, 0) + 1
+                return out
+        self.messages += 1
+        self.pending.append([key, d, 0, self.count, ts, ts, cc])
+        return out
+
+    def expire(self, ts=None):
+        out = []
+        pending = self.pending
+        while pending:
+            entry = pending[0]
+            if self.count - entry[3] <= self.window:
+                if self.window_us is None or ts is None or entry[4] is None or ts - entry[4] <= self.window_us:
+                    break
+            out.append((entry[1], entry[2], entry[5], entry[6]))
+            pending.pop(0)
+        return out
+
+    def flush(self):
+        # everything that's still waiting for retries, for when the capture is over
+        out = [(entry[1], entry[2], entry[5], entry[6]) for entry in self.pending]
+        self.pending = []
+        return out
@@ -1,57 +1,23 @@
+# Turns sigrok I2C decoder output into a FUSB302 register access trace.
+# Export the "Address/data" annotations from PulseView/sigrok-cli, then:
+#
+#     python3 trace.py dec.txt
+#     sigrok-cli -i capture.sr -P i2c:scl=D0:sda=D1 -A i2c=address-data | python3 trace.py -r 43
+#
+# .sr sessions can be given directly too, those get decoded with ../sigrok.py (needs NumPy):
+#
+#     python3 trace.py pinecil_1.sr
+#
+# Every stage is a generator, so even multi-million-line exports go through in constant memory:
+# read_lines() -> assemble() -> decode() -> format_access()
 
-# transaction list
-tr = []
-
-# current transaction
-t = []
-
-# filter address
-addr = 0x22
+import argparse
+import os
+import sys
 
 # read/write keyword shortening
 tts = {"write:":'wr', "read:":'rd'}
 
-with open('dec.txt', 'r') as f:
-  line = f.readline()
-  while line:
-    line = line.strip()
-    if not line:
-        break
-    tss, _, _, d = line.split(' ', 3)
-    if d == "Start":
-        # new transaction
-        # saving/discarding the current one
-        if t:
-            if t[1] != addr:
-                #print("Filtering transaction for", hex(t[0]), ":", t)
-                t = ["start"] # discarding the entire transaction
-            else:
-                tr.append(t)
-                t = ["start"]
-    elif d.startswith("Address "):
-        _, rw, a = d.split(' ', 2)
-        t.append(int(a, 16))
-        t.append(tts[rw])
-    elif d.startswith("Data"):
-        _, rw, dt = d.split(' ', 2)
-        t.append(tts[rw])
-        t.append(int(dt, 16))
-    elif d in ['ACK', 'NACK', 'Stop', 'Start repeat']:
-        t.append(d.lower())
-    #new line
-    line = f.readline()
-
-
-print("-----------------------")
-
-def myhex(i):
-    return '0x'+hex(i)[2:].zfill(2)
-
-def mybin(i):
-    return '0b'+bin(i)[2:].zfill(8)
-
-# second parsing
-
 regs = {
     0x00: "CTRL3",
     0x01: "DEV_ID",
@@ -82,22 +48,127 @@ regs = {
 
 longest_regn = max(map(len, regs.values()))
 
-for t in tr:
-    addr = t[1]
-    reg = t[5]
-    t = t[7:]
-    if t[0] == 'start repeat':
-        t = t[4:]
-    op = t[0]
-    d = [t[1]]
-    t = t[2:]
-    for el in t:
-        if el in ['ack', 'nack', 'stop', 'rd', 'wr']:
+def myhex(i):
+    return '0x'+hex(i)[2:].zfill(2)
+
+def mybin(i):
+    return '0b'+bin(i)[2:].zfill(8)
+
+def read_lines(paths):
+    # yields non-empty lines from all the files in order; "-" or no files at all means stdin
+    if not paths:
+        paths = ["-"]
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path, 'r')
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+def assemble(lines, addrs=None):
+    # groups decoder annotations into transactions, yielding them as token lists:
+    # ["start", addr, 'wr', 'ack', 'wr', reg, 'ack', 'start repeat', addr, 'rd', 'ack', 'rd', data, 'nack', 'stop']
+    # transactions for addresses not in `addrs` are dropped as soon as their address is seen
+    t = None
+    skip = False
+    for line in lines:
+        try:
+            tss, _, _, d = line.split(' ', 3)
+        except ValueError:
+            continue # not an annotation line
+        if d == "Start":
+            # new transaction, saving the current one unless it's filtered out
+            if t and not skip:
+                yield t
+            t = ["start"]
+            skip = False
+        elif t is None or skip:
+            # nothing before the first Start is usable, and filtered transactions aren't worth keeping
             continue
-        d.append(el)
+        elif d.startswith("Address "):
+            _, rw, a = d.split(' ', 2)
+            a = int(a, 16)
+            if len(t) == 1 and addrs is not None and a not in addrs:
+                skip = True
+                continue
+            t.append(a)
+            t.append(tts[rw])
+        elif d.startswith("Data"):
+            _, rw, dt = d.split(' ', 2)
+            t.append(tts[rw])
+            t.append(int(dt, 16))
+        elif d in ['ACK', 'NACK', 'Stop', 'Start repeat']:
+            t.append(d.lower())
+    if t and not skip:
+        yield t
+
+def transactions(paths, addrs=None, scl="D0", sda="D1"):
+    # transactions from all the inputs in order, text exports and .sr sessions alike
+    if not paths:
+        paths = ["-"]
+    for path in paths:
+        if path.endswith(".sr"):
+            # sigrok.py is in the repo root, one level up; only needed (along with NumPy) for .sr files
+            repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+            if repo_dir not in sys.path:
+                sys.path.insert(0, repo_dir)
+            from sigrok import load_i2c
+            for t in load_i2c(path, scl, sda, addrs):
+                yield t
+        else:
+            for t in assemble(read_lines([path]), addrs):
+                yield t
+
+def decode(transactions, reg_filter=None):
+    # turns transactions into register accesses: (addr, reg, op, data list)
+    # transactions that don't address a register (like bus scans) are skipped
+    for t in transactions:
+        if len(t) < 6 or not isinstance(t[5], int):
+            continue
+        addr = t[1]
+        reg = t[5]
+        if reg_filter is not None and reg not in reg_filter:
+            continue
+        t = t[7:]
+        if t and t[0] == 'start repeat':
+            t = t[4:]
+        if len(t) < 2:
+            continue # register pointer write with no data
+        op = t[0]
+        d = [t[1]]
+        for el in t[2:]:
+            if el in ['ack', 'nack', 'stop', 'rd', 'wr']:
+                continue
+            d.append(el)
+        yield addr, reg, op, d
+
+def format_access(addr, reg, op, d):
     data = " ".join(list(map(myhex, d)))
     data += ' ({})'.format(" ".join(list(map(mybin, d))))
     reg_str = "{} ({})".format(myhex(reg), regs.get(reg, " ").rjust(longest_regn, ' '))
-    print(myhex(addr), reg_str, op, data)
+    return " ".join((myhex(addr), reg_str, op, data))
+
+def hex_int(s):
+    return int(s, 16)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode FUSB302 register accesses from sigrok I2C annotations")
+    parser.add_argument("paths", nargs="*", help="annotation exports or .sr sessions, stdin if none or -")
+    parser.add_argument("-a", "--addr", type=hex_int, action="append", help="I2C address to keep, in hex (default: 22); can be repeated")
+    parser.add_argument("-A", "--all-addrs", action="store_true", help="keep transactions for all addresses")
+    parser.add_argument("-r", "--reg", type=hex_int, action="append", help="register to keep, in hex; can be repeated")
+    parser.add_argument("--scl", default="D0", help="SCL probe name for .sr sessions (default: D0)")
+    parser.add_argument("--sda", default="D1", help="SDA probe name for .sr sessions (default: D1)")
+    args = parser.parse_args(argv)
 
+    addrs = None if args.all_addrs else set(args.addr or [0x22])
+    reg_filter = set(args.reg) if args.reg else None
+    for access in decode(transactions(args.paths, addrs, args.scl, args.sda), reg_filter):
+        print(format_access(*access))
 
+if __name__ == "__main__":
+    main()
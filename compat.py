@@ -0,0 +1,28 @@
+# Bits of MicroPython that the state machines and the tools need when they run under CPython:
+# ticks_*() that wrap around the same way, and a stream that swallows whatever is written to it.
+
+# MicroPython's ticks wrap around at 2^30
+TICKS_PERIOD = 1 << 30
+
+try:
+    from time import ticks_us, ticks_ms, ticks_diff
+except ImportError:
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return (perf_counter_ns() // 1000) & (TICKS_PERIOD - 1)
+
+    def ticks_ms():
+        return (perf_counter_ns() // 1000000) & (TICKS_PERIOD - 1)
+
+    def ticks_diff(ticks1, ticks2):
+        diff = (ticks1 - ticks2) & (TICKS_PERIOD - 1)
+        return diff - TICKS_PERIOD if diff >= TICKS_PERIOD // 2 else diff
+
+class Null():
+    # for sys.stdout while benchmarking, and anywhere else output needs to go nowhere
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
@@ -1,4 +1,5 @@
 from time import sleep
+from machine import idle
 
 ########################
 #
@@ -30,24 +31,76 @@ class FUSB302():
     REG_INTERRUPT = 0x42
     REG_FIFOS = 0x43
 
-    def __init__(self, bus, addr=0x22, int_p=None):
+    # configuration registers that only change when we write them,
+    # and can therefore be kept in a write-through shadow copy
+    shadow_regs = (
+        REG_SWITCHES0, REG_SWITCHES1, REG_MEASURE,
+        REG_CONTROL0, REG_CONTROL1, REG_CONTROL2, REG_CONTROL3,
+        REG_MASK, REG_POWER, REG_MASKA, REG_MASKB,
+    )
+
+    # bits that the FUSB clears by itself after acting on them,
+    # these never get stored in the shadow copy
+    self_clearing_bits = {
+        REG_CONTROL0: 0b01000001, # TX_FLUSH, TX_START
+        REG_CONTROL1: 0b00000100, # RX_FLUSH
+        REG_CONTROL3: 0b01000000, # SEND_HARD_RESET
+    }
+
+    def __init__(self, bus, addr=0x22, int_p=None, shadow=False):
         self.bus = bus
         self.addr = addr
         self.int_p = int_p
+        # register shadow is opt-in; None means every access goes to the bus.
+        # it only covers configuration registers, status and interrupt reads still go out
+        self.shadow = {} if shadow else None
+        # local copy of the RX FIFO, used by get_rxb_burst()
+        self.rx_buf = b''
+        self.rx_pos = 0
+
+    def read_reg(self, reg):
+        # read a single register, served from the shadow copy where possible
+        shadow = self.shadow
+        if shadow is not None and reg in shadow:
+            return shadow[reg]
+        x = self.bus.readfrom_mem(self.addr, reg, 1)[0]
+        if shadow is not None and reg in self.shadow_regs:
+            shadow[reg] = x
+        return x
+
+    def write_reg(self, reg, x):
+        # write a single register, keeping the shadow copy in sync
+        self.bus.writeto_mem(self.addr, reg, bytes((x,)) )
+        shadow = self.shadow
+        if shadow is not None and reg in self.shadow_regs:
+            shadow[reg] = x & ~self.self_clearing_bits.get(reg, 0) & 0xFF
+
+    def invalidate_shadow(self, reg=None):
+        # drop the shadow copy of one register, or all of them
+        if self.shadow is None:
+            return
+        if reg is None:
+            self.shadow.clear()
+        else:
+            self.shadow.pop(reg, None)
 
     def reset(self):
         # reset the entire FUSB
         self.bus.writeto_mem(self.addr, self.REG_RESET, bytes([0b1]))
+        # all registers are back to their defaults now
+        self.invalidate_shadow()
+        self.drop_rxb()
 
     def reset_pd(self):
         # resets the FUSB PD logic
         self.bus.writeto_mem(self.addr, self.REG_RESET, bytes([0b10]))
+        self.drop_rxb()
 
     def unmask_all(self):
         # unmasks all interrupts
-        self.bus.writeto_mem(self.addr, self.REG_MASK, bytes([0b0]))
-        self.bus.writeto_mem(self.addr, self.REG_MASKA, bytes([0b0]))
-        self.bus.writeto_mem(self.addr, self.REG_MASKB, bytes([0b0]))
+        self.write_reg(self.REG_MASK, 0b0)
+        self.write_reg(self.REG_MASKA, 0b0)
+        self.write_reg(self.REG_MASKB, 0b0)
 
     def cc_current(self):
         # show measured CC level interpreted as USB-C current levels
@@ -56,44 +109,44 @@ class FUSB302():
     def read_cc(self, cc):
         # enable a CC pin for reading
         assert(cc in [0, 1, 2])
-        x = self.bus.readfrom_mem(self.addr, self.REG_SWITCHES0, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES0)
         x1 = x
         clear_mask = ~0b1100 & 0xFF
         x &= clear_mask
         mask = [0b0, 0b100, 0b1000][cc]
         x |= mask
         #print('self.REG_SWITCHES0: ', bin(x1), bin(x), cc)
-        self.bus.writeto_mem(self.addr, self.REG_SWITCHES0, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES0, x)
 
     def enable_pullups(self):
         # enable host pullups on CC pins, disable pulldowns
-        x = self.bus.readfrom_mem(0x22, 0x02, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES0)
         x |= 0b11000000
-        self.bus.writeto_mem(0x22, 0x02, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES0, x)
 
     def set_mdac(self, value):
-        x = self.bus.readfrom_mem(0x22, 0x04, 1)[0]
+        x = self.read_reg(self.REG_MEASURE)
         x &= 0b11000000
         x |= value
-        self.bus.writeto_mem(0x22, 0x04, bytes((x,)) )
+        self.write_reg(self.REG_MEASURE, x)
 
     def enable_sop(self):
         # enable reception of SOP'/SOP" messages
-        x = self.bus.readfrom_mem(self.addr, self.REG_CONTROL1, 1)[0]
+        x = self.read_reg(self.REG_CONTROL1)
         mask = 0b1100011
         x |= mask
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL1, bytes((x,)) )
+        self.write_reg(self.REG_CONTROL1, x)
 
     def disable_pulldowns(self):
-        x = self.bus.readfrom_mem(self.addr, self.REG_SWITCHES0, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES0)
         clear_mask = ~0b11 & 0xFF
         x &= clear_mask
-        self.bus.writeto_mem(self.addr, self.REG_SWITCHES0, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES0, x)
 
     def enable_pulldowns(self):
-        x = self.bus.readfrom_mem(self.addr, self.REG_SWITCHES0, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES0)
         x |= 0b11
-        self.bus.writeto_mem(self.addr, self.REG_SWITCHES0, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES0, x)
 
     def measure_sink(self, debug=False):
         # read CC pins and see which one senses the pullup
@@ -130,10 +183,10 @@ class FUSB302():
     def set_controls_sink(self):
         # boot: 0b00100100
         ctrl0 = 0b00000000 # unmask all interrupts; don't autostart TX.. disable pullup current
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL0, bytes((ctrl0,)) )
+        self.write_reg(self.REG_CONTROL0, ctrl0)
         # boot: 0b00000110
         ctrl3 = 0b00000111 # enable automatic packet retries
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL3, bytes((ctrl3,)) )
+        self.write_reg(self.REG_CONTROL3, ctrl3)
 
     host_current=0b10
 
@@ -141,39 +194,39 @@ class FUSB302():
         # boot: 0b00100100
         ctrl0 = 0b00000000 # unmask all interrupts; don't autostart TX
         ctrl0 |= self.host_current << 2 # set host current advertisement pullups
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL0, bytes((ctrl0,)) )
-        self.bus.writeto_mem(0x22, 0x06, bytes((ctrl0,)) )
+        self.write_reg(self.REG_CONTROL0, ctrl0)
         # boot: 0b00000110
         ctrl3 = 0b00000110 # no automatic packet retries
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL3, bytes((ctrl3,)) )
+        self.write_reg(self.REG_CONTROL3, ctrl3)
         # boot: 0b00000010
         #ctrl2 = 0b00000000 # disable DRP toggle. setting it to Do Not Use o_o ???
         #self.bus.writeto_mem(self.addr, self.REG_CONTROL2, bytes((ctrl2,)) )
 
     def set_wake(self, state):
         # boot: 0b00000010
-        ctrl2 = self.bus.readfrom_mem(0x22, 0x08, 1)[0]
+        ctrl2 = self.read_reg(self.REG_CONTROL2)
         clear_mask = ~(1 << 3) & 0xFF
         ctrl2 &= clear_mask
         if state:
             ctrl2 | (1 << 3)
-        self.bus.writeto_mem(0x22, 0x08, bytes((ctrl2,)) )
+        self.write_reg(self.REG_CONTROL2, ctrl2)
 
     def flush_receive(self):
-        x = self.bus.readfrom_mem(self.addr, self.REG_CONTROL1, 1)[0]
+        x = self.read_reg(self.REG_CONTROL1)
         mask = 0b100 # flush receive
         x |= mask
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL1, bytes((x,)) )
+        self.write_reg(self.REG_CONTROL1, x)
+        self.drop_rxb()
 
     def flush_transmit(self):
-        x = self.bus.readfrom_mem(self.addr, self.REG_CONTROL0, 1)[0]
+        x = self.read_reg(self.REG_CONTROL0)
         mask = 0b01000000 # flush transmit
         x |= mask
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL0, bytes((x,)) )
+        self.write_reg(self.REG_CONTROL0, x)
 
     def enable_tx(self, cc):
         # enables switch on either CC1 or CC2
-        x = self.bus.readfrom_mem(self.addr, self.REG_SWITCHES1, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES1)
         x1 = x
         mask = 0b10 if cc == 2 else 0b1
         x &= 0b10011100 # clearing both TX bits and revision bits
@@ -181,21 +234,21 @@ class FUSB302():
         x |= 0b100
         x |= 0b10 << 5 # revision 3.0
         #print('et', bin(x1), bin(x), cc)
-        self.bus.writeto_mem(self.addr, self.REG_SWITCHES1, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES1, x)
 
     def set_roles(self, power_role = 0, data_role = 0):
-        x = self.bus.readfrom_mem(0x22, 0x03, 1)[0]
+        x = self.read_reg(self.REG_SWITCHES1)
         x &= 0b01101111 # clearing both role bits
         x |= power_role << 7
         x |= data_role << 7
-        self.bus.writeto_mem(0x22, 0x03, bytes((x,)) )
+        self.write_reg(self.REG_SWITCHES1, x)
 
     def power(self):
         # enables all power circuits
-        x = self.bus.readfrom_mem(self.addr, self.REG_POWER, 1)[0]
+        x = self.read_reg(self.REG_POWER)
         mask = 0b1111
         x |= mask
-        self.bus.writeto_mem(self.addr, self.REG_POWER, bytes((x,)) )
+        self.write_reg(self.REG_POWER, x)
 
     def polarity(self):
         # reads polarity and role bits from STATUS1A
@@ -204,7 +257,33 @@ class FUSB302():
 
     def interrupts(self):
         # return all interrupt registers
-        return self.bus.readfrom_mem(self.addr, self.REG_INTERRUPTA, 2)+self.bus.readfrom_mem(self.addr, self.REG_INTERRUPT, 1)
+        i = self.bus.readfrom_mem(self.addr, self.REG_INTERRUPTA, 2)+self.bus.readfrom_mem(self.addr, self.REG_INTERRUPT, 1)
+        if i[1] & 0x01 or i[2] & 0x10: # I_GCRCSENT, I_CRC_CHK
+            # a message has been received in full, get_rxb_burst() can drain the FIFO
+            self.rx_complete = True
+        return i
+
+    # set from the int_p IRQ handler, cleared by whoever reads the interrupt registers
+    int_flag = False
+
+    def enable_irq(self):
+        # latch falling edges on int_p, so that the bus only needs
+        # to be checked after the FUSB has signalled an event
+        self.int_flag = self.int_p.value() == 0
+        self.int_p.irq(self.int_cb, trigger=self.int_p.IRQ_FALLING)
+
+    def disable_irq(self):
+        self.int_p.irq(None)
+
+    def int_cb(self, pin):
+        # runs in IRQ context, keep it short
+        self.int_flag = True
+
+    def wait_int(self):
+        # lets the CPU sleep until int_p goes low. any other interrupt wakes it up as well,
+        # the system tick at the latest, so callers still get to check their timeouts every millisecond or so
+        if not self.int_flag:
+            idle()
 
     # interrupts are cleared just by reading them, it seems
     #def clear_interrupts(self):
@@ -228,8 +307,53 @@ class FUSB302():
         # read from FIFO
         return self.bus.readfrom_mem(self.addr, self.REG_FIFOS, l)
 
+    rx_burst_len = 80
+
+    # set by interrupts() once the FUSB has received a whole message, cleared by the next burst read
+    rx_complete = False
+
+    def get_rxb_burst(self, l=80):
+        # read from FIFO, same as get_rxb, except that the whole FIFO is drained
+        # in one transaction and subsequent reads are served from memory.
+        # that only happens after interrupts() has seen a message come in in full;
+        # until then, reads go to the FIFO token by token, like get_rxb() does
+        buf = self.rx_buf
+        pos = self.rx_pos
+        if pos + l > len(buf):
+            if not self.rx_complete:
+                data = buf[pos:] + self.get_rxb(l - (len(buf) - pos))
+                self.drop_rxb()
+                return data
+            self.rx_complete = False
+            buf = buf[pos:] + self.bus.readfrom_mem(self.addr, self.REG_FIFOS, self.rx_burst_len)
+            pos = 0
+            self.rx_buf = buf
+        self.rx_pos = pos + l
+        return buf[pos:pos+l]
+
+    def rx_buffered(self):
+        # whether get_rxb_burst() still holds unread messages.
+        # the FIFO reads out as zeroes once it's empty, and no token starts with 0,
+        # so a zero where the next message would start means we've got nothing left.
+        # this assumes the FIFO only held complete messages when it got drained, which is what
+        # waiting for I_GCRCSENT/I_CRC_CHK is for. a message that started coming in between
+        # the interrupt read and the burst would get cut short; in practice, the partner waits
+        # for our GoodCRC and then for our reply, so there's nothing else on the wire by then
+        buf = self.rx_buf
+        pos = self.rx_pos
+        if pos < len(buf) and buf[pos] != 0:
+            return True
+        if buf:
+            self.drop_rxb()
+        return False
+
+    def drop_rxb(self):
+        # forget whatever get_rxb_burst() has buffered
+        self.rx_buf = b''
+        self.rx_pos = 0
+
     def hard_reset(self):
-        self.bus.writeto_mem(self.addr, self.REG_CONTROL3, bytes([0b1000000]))
+        self.write_reg(self.REG_CONTROL3, 0b1000000)
         return self.bus.readfrom_mem(self.addr, self.REG_CONTROL3, 1)
 
     def find_cc(self, fn="measure_sink", debug=False):
@@ -277,12 +401,26 @@ class FUSB302():
     def p_cur(self):
         return current_values[self.cc_current()]
 
-    def send(self, message):
-        sop_seq = [0x12, 0x12, 0x12, 0x13, 0x80]
-        eop_seq = [0xff, 0x14, 0xfe, 0xa1]
-
-        sop_seq[4] |= len(message)
-
-        self.bus.writeto_mem(self.addr, self.REG_FIFOS, bytes(sop_seq) )
-        self.bus.writeto_mem(self.addr, self.REG_FIFOS, bytes(message) )
-        self.bus.writeto_mem(self.addr, self.REG_FIFOS, bytes(eop_seq) )
+    # TX FIFO tokens
+    sop_seq = b'\x12\x12\x12\x13' # SYNC1 x3, SYNC2
+    eop_seq = b'\xff\x14\xfe' # JAM_CRC, EOP, TXOFF
+    TOKEN_PACKSYM = 0x80
+    TOKEN_TXON = 0xa1
+
+    def send(self, message, tx_on=True):
+        # the entire token stream is built up front and goes into the FIFO in one write.
+        # with tx_on, the TXON token at the end starts transmission as soon as the write is done;
+        # otherwise, call start_tx() whenever it's time to send
+        buf = bytearray(self.sop_seq)
+        buf.append(self.TOKEN_PACKSYM | len(message))
+        buf += bytes(message)
+        buf += self.eop_seq
+        if tx_on:
+            buf.append(self.TOKEN_TXON)
+        self.bus.writeto_mem(self.addr, self.REG_FIFOS, buf)
+
+    def start_tx(self):
+        # transmit whatever has been loaded into the TX FIFO
+        x = self.read_reg(self.REG_CONTROL0)
+        x |= 0b1 # TX_START
+        self.write_reg(self.REG_CONTROL0, x)
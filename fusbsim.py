@@ -0,0 +1,376 @@
+########################
+#
+# Virtual FUSB302
+#
+########################
+
+# A register-level model of the FUSB302, for running the stack without hardware.
+# Attach it to the machine.py I2C mock, and FUSB302/PDStacc talk to it like they would to the real chip:
+#
+#     i2c = I2C(sda=Pin(18), scl=Pin(19), id=1, freq=400000)
+#     int_p = Pin(20, Pin.IN, Pin.PULL_UP)
+#     vfusb = VirtualFUSB302(int_p=int_p)
+#     i2c.attach(vfusb)
+#     vfusb.attach(cc=1, bc_lvl=3) # plug in a 3A source on CC1
+#     vfusb.feed(capture_bytes) # FIFO contents from sniffer.py captures
+#
+# What's modelled: the register file with reset defaults and self-clearing bits,
+# the RX FIFO with SOP tokens and CRCs, TX FIFO token parsing, STATUS0/STATUS1 bits,
+# read-to-clear interrupt registers with masks, the INT_N pin, and automatic GoodCRC replies.
+# Transmission is instant, and without anything on the other end, every message counts as sent;
+# loopback.py connects two of these together.
+
+from pdstacc import crc32
+
+REG_DEVICE_ID = 0x01
+REG_SWITCHES0 = 0x02
+REG_SWITCHES1 = 0x03
+REG_MEASURE = 0x04
+REG_CONTROL0 = 0x06
+REG_CONTROL1 = 0x07
+REG_CONTROL2 = 0x08
+REG_CONTROL3 = 0x09
+REG_MASK = 0x0A
+REG_POWER = 0x0B
+REG_RESET = 0x0C
+REG_MASKA = 0x0E
+REG_MASKB = 0x0F
+REG_STATUS0A = 0x3C
+REG_STATUS1A = 0x3D
+REG_INTERRUPTA = 0x3E
+REG_INTERRUPTB = 0x3F
+REG_STATUS0 = 0x40
+REG_STATUS1 = 0x41
+REG_INTERRUPT = 0x42
+REG_FIFOS = 0x43
+
+# register values after power-up or a SW_RES, from the datasheet
+reset_values = {
+    REG_DEVICE_ID: 0x91,
+    REG_SWITCHES0: 0x03,
+    REG_SWITCHES1: 0x20,
+    REG_MEASURE: 0x31,
+    0x05: 0x60, # SLICE
+    REG_CONTROL0: 0x24,
+    REG_CONTROL1: 0x00,
+    REG_CONTROL2: 0x02,
+    REG_CONTROL3: 0x06,
+    REG_POWER: 0x01,
+    0x0D: 0x0F, # OCPREG
+}
+
+# bits that read back as 0, since the FUSB clears them after acting on them
+self_clearing_bits = {
+    REG_CONTROL0: 0b01000001, # TX_FLUSH, TX_START
+    REG_CONTROL1: 0b00000100, # RX_FLUSH
+    REG_CONTROL3: 0b01000000, # SEND_HARD_RESET
+    REG_RESET: 0b00000011, # PD_RESET, SW_RES
+}
+
+# INTERRUPT bits
+I_BC_LVL = 0x01
+I_COLLISION = 0x02
+I_WAKE = 0x04
+I_ALERT = 0x08
+I_CRC_CHK = 0x10
+I_COMP_CHNG = 0x20
+I_ACTIVITY = 0x40
+I_VBUSOK = 0x80
+# INTERRUPTA bits
+I_HARDRST = 0x01
+I_SOFTRST = 0x02
+I_TXSENT = 0x04
+I_HARDSENT = 0x08
+I_RETRYFAIL = 0x10
+# INTERRUPTB bits
+I_GCRCSENT = 0x01
+
+# TX FIFO tokens
+TX_SYNC1 = 0x12
+TX_SYNC2 = 0x13
+TX_SYNC3 = 0x1B
+TX_RESET1 = 0x15
+TX_RESET2 = 0x16
+TX_PACKSYM = 0x80
+TX_JAM_CRC = 0xFF
+TX_EOP = 0x14
+TX_TXOFF = 0xFE
+TX_TXON = 0xA1
+
+# ordered sets made of TX tokens
+tx_ordered_sets = {
+    (TX_SYNC1, TX_SYNC1, TX_SYNC1, TX_SYNC2): "SOP",
+    (TX_SYNC1, TX_SYNC1, TX_SYNC3, TX_SYNC3): "SOP'",
+    (TX_SYNC1, TX_SYNC3, TX_SYNC1, TX_SYNC3): "SOP''",
+    (TX_RESET1, TX_RESET1, TX_RESET1, TX_RESET2): "Hard_Reset",
+}
+
+# RX FIFO tokens for the SOPs, and the CONTROL1 bit that has to be set for them to be received
+rx_tokens = {"SOP": (0xe0, 0), "SOP'": (0xc0, 0b1), "SOP''": (0xa0, 0b10)}
+
+FIFO_SIZE = 80
+
+class VirtualFUSB302():
+    addr = 0x22
+
+    def __init__(self, addr=None, int_p=None, sent_depth=32):
+        if addr is not None:
+            self.addr = addr
+        self.int_p = int_p
+        self.int_level = None
+        # BC_LVL that each CC pin sees, set by attach()
+        self.cc_levels = [0, 0]
+        self.vbus = False
+        # captured FIFO contents waiting for room in the RX FIFO
+        self.rx_queue = []
+        # transmitted messages as (SOP name, header+data bytes), the most recent `sent_depth` of them
+        self.sent = []
+        self.sent_depth = sent_depth
+        # called with (SOP name, header+data bytes) for every transmitted message,
+        # returns False if no GoodCRC came back for it
+        self.tx_cb = None
+        # bus transaction counters
+        self.reads = 0
+        self.writes = 0
+        self.sw_reset()
+
+    def sw_reset(self):
+        self.regs = bytearray(256)
+        for reg, value in reset_values.items():
+            self.regs[reg] = value
+        self.rx = b''
+        self.tx = bytearray()
+        self.update_int()
+
+    ########################
+    #
+    # I2C side
+    #
+    ########################
+
+    def read_mem(self, reg, nbytes):
+        self.reads += 1
+        if reg == REG_FIFOS:
+            return self.read_fifo(nbytes)
+        # registers auto-increment on multi-byte reads
+        return bytes([self.read_reg(reg + i) for i in range(nbytes)])
+
+    def write_mem(self, reg, buf):
+        self.writes += 1
+        if reg == REG_FIFOS:
+            self.write_fifo(buf)
+            return
+        for i, x in enumerate(buf):
+            self.write_reg(reg + i, x)
+
+    def read_reg(self, reg):
+        if reg == REG_STATUS0:
+            return self.status0()
+        if reg == REG_STATUS1:
+            return self.status1()
+        x = self.regs[reg]
+        if reg in (REG_INTERRUPT, REG_INTERRUPTA, REG_INTERRUPTB):
+            # interrupt registers are cleared by reading them
+            self.regs[reg] = 0
+            self.update_int()
+        return x
+
+    def write_reg(self, reg, x):
+        if reg == REG_RESET:
+            if x & 0b1: # SW_RES
+                self.sw_reset()
+            return
+        if reg in (REG_INTERRUPT, REG_INTERRUPTA, REG_INTERRUPTB, REG_STATUS0, REG_STATUS1, REG_DEVICE_ID):
+            return # read-only
+        self.regs[reg] = x & ~self_clearing_bits.get(reg, 0) & 0xFF
+        if reg == REG_CONTROL0:
+            if x & 0b01000000: # TX_FLUSH
+                self.tx = bytearray()
+            if x & 0b1: # TX_START
+                self.transmit_fifo()
+        elif reg == REG_CONTROL1:
+            if x & 0b100: # RX_FLUSH
+                self.rx = b''
+                self.pump_rx()
+        elif reg == REG_CONTROL3:
+            if x & 0b01000000: # SEND_HARD_RESET
+                self.transmit("Hard_Reset", b'')
+                self.interrupt(REG_INTERRUPTA, I_HARDSENT)
+        self.update_int()
+
+    ########################
+    #
+    # Status and interrupts
+    #
+    ########################
+
+    def status0(self):
+        x = self.regs[REG_STATUS0] & 0b11111100
+        meas = self.regs[REG_SWITCHES0] >> 2 & 0b11
+        if meas == 0b01:
+            x |= self.cc_levels[0]
+        elif meas == 0b10:
+            x |= self.cc_levels[1]
+        if self.vbus:
+            x |= 0x80
+        return x
+
+    def status1(self):
+        x = 0
+        if not self.rx:
+            x |= 0b100000 # RX_EMPTY
+        if len(self.rx) >= FIFO_SIZE:
+            x |= 0b10000 # RX_FULL
+        if not self.tx:
+            x |= 0b1000 # TX_EMPTY
+        return x
+
+    def interrupt(self, reg, bits):
+        self.regs[reg] |= bits
+        self.update_int()
+
+    def update_int(self):
+        # INT_N goes low while any unmasked interrupt is pending, unless INT_MASK is set
+        regs = self.regs
+        pending = (regs[REG_INTERRUPT] & ~regs[REG_MASK]) | (regs[REG_INTERRUPTA] & ~regs[REG_MASKA]) | (regs[REG_INTERRUPTB] & ~regs[REG_MASKB] & 1)
+        if regs[REG_CONTROL0] & 0b100000: # INT_MASK
+            pending = 0
+        level = 0 if pending & 0xFF else 1
+        if level != self.int_level:
+            self.int_level = level
+            if self.int_p is not None:
+                self.int_p.value(level)
+
+    ########################
+    #
+    # CC line
+    #
+    ########################
+
+    def attach(self, cc=1, bc_lvl=3, vbus=True):
+        # something got plugged in; the CC pin it's on will read `bc_lvl`
+        self.cc_levels = [0, 0]
+        self.cc_levels[cc - 1] = bc_lvl
+        self.vbus = vbus
+        self.interrupt(REG_INTERRUPT, I_BC_LVL | I_COMP_CHNG | (I_VBUSOK if vbus else 0))
+
+    def detach(self):
+        self.cc_levels = [0, 0]
+        vbus = self.vbus
+        self.vbus = False
+        self.interrupt(REG_INTERRUPT, I_BC_LVL | I_COMP_CHNG | (I_VBUSOK if vbus else 0))
+
+    ########################
+    #
+    # RX FIFO
+    #
+    ########################
+
+    def read_fifo(self, nbytes):
+        # past the end of the FIFO, reads return zeroes
+        data = self.rx[:nbytes]
+        self.rx = self.rx[nbytes:]
+        if len(data) < nbytes:
+            data += bytes(nbytes - len(data))
+        self.pump_rx()
+        return data
+
+    def feed(self, data):
+        # queues raw FIFO contents, like the ones recorded by sniffer.py, token and CRC included.
+        # each chunk goes into the FIFO once there's room for it, raising I_CRC_CHK
+        self.rx_queue.append(bytes(data))
+        self.pump_rx()
+
+    def pump_rx(self):
+        queue = self.rx_queue
+        while queue and len(self.rx) + len(queue[0]) <= FIFO_SIZE:
+            self.rx += queue.pop(0)
+            self.interrupt(REG_INTERRUPT, I_CRC_CHK | I_ACTIVITY)
+
+    def receive(self, sop, message):
+        # a message arrives over CC; message is header+data, the CRC gets added here.
+        # returns True if we answered with a GoodCRC, False if we didn't
+        # or if the message was dropped - SOP type not enabled, or no room in the FIFO
+        token, enable_bit = rx_tokens.get(sop, (None, 0))
+        if token is None:
+            return False
+        if enable_bit and not self.regs[REG_CONTROL1] & enable_bit:
+            return False
+        if len(self.rx) + 1 + len(message) + 4 > FIFO_SIZE:
+            return False
+        crc = crc32(message)
+        self.rx += bytes((token,)) + bytes(message) + bytes((crc & 0xFF, (crc >> 8) & 0xFF, (crc >> 16) & 0xFF, crc >> 24))
+        self.interrupt(REG_INTERRUPT, I_CRC_CHK | I_ACTIVITY)
+        # with AUTO_CRC, SOP messages get a GoodCRC from the FUSB itself - except for GoodCRCs
+        is_goodcrc = message[0] & 0b11111 == 1 and not message[1] & 0b1110000
+        if sop == "SOP" and self.regs[REG_SWITCHES1] & 0b100 and not is_goodcrc:
+            self.send_goodcrc(message)
+            return True
+        return False
+
+    def send_goodcrc(self, message):
+        # the header is built from the SWITCHES1 role and revision bits, and the ID of the message received
+        switches1 = self.regs[REG_SWITCHES1]
+        b0 = 0b1 | (switches1 & 0b10000) << 1 | (switches1 & 0b1100000) << 1
+        b1 = switches1 >> 7 | (message[1] & 0b1110)
+        self.transmit("SOP", bytes((b0, b1)))
+        self.interrupt(REG_INTERRUPTB, I_GCRCSENT)
+
+    ########################
+    #
+    # TX FIFO
+    #
+    ########################
+
+    def write_fifo(self, buf):
+        self.tx += buf
+        self.transmit_fifo(False)
+
+    def transmit_fifo(self, start=True):
+        # parses the TX FIFO tokens; packets in it go out once a TXON token shows up, or TX_START is set
+        tx = self.tx
+        packets = []
+        syncs = []
+        message = None
+        i = 0
+        while i < len(tx):
+            token = tx[i]
+            i += 1
+            if token in (TX_SYNC1, TX_SYNC2, TX_SYNC3, TX_RESET1, TX_RESET2):
+                syncs.append(token)
+                if tuple(syncs[-4:]) == (TX_RESET1, TX_RESET1, TX_RESET1, TX_RESET2):
+                    packets.append(("Hard_Reset", b''))
+                    syncs = []
+            elif (token & 0b11100000) == TX_PACKSYM:
+                # the packed bytes follow, so they can't be mistaken for tokens
+                l = token & 0b11111
+                message = (message or b'') + bytes(tx[i:i+l])
+                i += l
+            elif token == TX_EOP:
+                sop = tx_ordered_sets.get(tuple(syncs[-4:]), None)
+                if sop is not None and message is not None:
+                    packets.append((sop, message))
+                syncs = []
+                message = None
+            elif token == TX_TXON:
+                start = True
+            # JAM_CRC and TXOFF don't change what gets sent
+        if not start:
+            return
+        self.tx = bytearray()
+        for sop, message in packets:
+            acked = self.transmit(sop, message)
+            if sop == "Hard_Reset":
+                self.interrupt(REG_INTERRUPTA, I_HARDSENT)
+            else:
+                self.interrupt(REG_INTERRUPTA, I_TXSENT if acked else I_RETRYFAIL)
+
+    def transmit(self, sop, message):
+        # returns whether the message got a GoodCRC
+        sent = self.sent
+        sent.append((sop, message))
+        if len(sent) > self.sent_depth:
+            sent.pop(0)
+        if self.tx_cb is not None:
+            return self.tx_cb(sop, message) is not False
+        return True
@@ -0,0 +1,207 @@
+# Profiles the I2C traffic between the stack and the FUSB302: reads, writes and bytes per register,
+# attributed to the high-level operation (find_cc, get_message, send, interrupts...) that caused them,
+# plus how long each of those operations takes.
+#
+#     prof = BusProfiler(fusb, stacc)
+#     prof.enable()
+#     ... run the stack ...
+#     prof.disable()
+#     prof.show()
+#
+# Nothing is wrapped until enable() is called, and disable() puts the original bus and methods back,
+# so it costs nothing while disabled and can be left in firmware.
+
+from compat import ticks_us, ticks_diff
+
+# operations that get their bus traffic and latency accounted for separately.
+# when one of these calls another, everything is attributed to the outermost one
+fusb_ops = (
+    "reset", "reset_pd", "hard_reset",
+    "find_cc", "measure_sink", "measure_source", "read_cc", "cc_current", "polarity",
+    "flush_receive", "flush_transmit",
+    "interrupts", "rxb_state", "get_rxb", "get_rxb_burst",
+    "send", "start_tx",
+)
+stacc_ops = (
+    "init_fusb", "setup_sink", "setup_source", "setup_listen",
+    "get_message", "send_command",
+)
+
+# bus traffic from outside of any known operation
+OTHER = "other"
+
+# latency histogram bucket upper bounds, in microseconds; the last bucket is everything above
+hist_edges = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+class ProfiledBus():
+    # stands in for the I2C object, counting every transaction towards the current operation
+    def __init__(self, bus, profiler):
+        self.bus = bus
+        self.profiler = profiler
+
+    def readfrom_mem(self, addr, reg, n, **kwargs):
+        start = ticks_us()
+        data = self.bus.readfrom_mem(addr, reg, n, **kwargs)
+        self.profiler.count(reg, 0, n, ticks_diff(ticks_us(), start))
+        return data
+
+    def readfrom_mem_into(self, addr, reg, buf, **kwargs):
+        start = ticks_us()
+        self.bus.readfrom_mem_into(addr, reg, buf, **kwargs)
+        self.profiler.count(reg, 0, len(buf), ticks_diff(ticks_us(), start))
+
+    def writeto_mem(self, addr, reg, buf, **kwargs):
+        start = ticks_us()
+        self.bus.writeto_mem(addr, reg, buf, **kwargs)
+        self.profiler.count(reg, 1, len(buf), ticks_diff(ticks_us(), start))
+
+    def __getattr__(self, name):
+        # scan() and friends go straight through
+        return getattr(self.bus, name)
+
+class BusProfiler():
+    def __init__(self, fusb, stacc=None, fusb_ops=fusb_ops, stacc_ops=stacc_ops):
+        self.fusb = fusb
+        self.targets = [(fusb, fusb_ops)]
+        if stacc is not None:
+            self.targets.append((stacc, stacc_ops))
+        self.enabled = False
+        # (object, method name) pairs that have a wrapper installed
+        self.wrapped = []
+        # operation currently running, None if there's none
+        self.op = None
+        self.reset()
+
+    def reset(self):
+        # (operation, register) -> [reads, writes, bytes read, bytes written, bus time in us]
+        self.regs = {}
+        # operation -> [calls, total time in us, max time in us, histogram bucket counts]
+        self.ops = {}
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.bus = self.fusb.bus
+        self.fusb.bus = ProfiledBus(self.bus, self)
+        for obj, names in self.targets:
+            for name in names:
+                if hasattr(obj, name):
+                    setattr(obj, name, self.wrap(name, getattr(obj, name)))
+                    self.wrapped.append((obj, name))
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.fusb.bus = self.bus
+        # the wrappers are instance attributes, removing them uncovers the class methods again
+        for obj, name in self.wrapped:
+            delattr(obj, name)
+        self.wrapped = []
+        self.op = None
+        self.enabled = False
+
+    def wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            if self.op is not None:
+                # nested in another operation, which gets the credit
+                return method(*args, **kwargs)
+            self.op = name
+            start = ticks_us()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.op = None
+                self.timed(name, ticks_diff(ticks_us(), start))
+        return wrapper
+
+    def count(self, reg, write, n, us):
+        key = (self.op or OTHER, reg)
+        entry = self.regs.get(key)
+        if entry is None:
+            entry = [0, 0, 0, 0, 0]
+            self.regs[key] = entry
+        entry[write] += 1
+        entry[2 + write] += n
+        entry[4] += us
+
+    def timed(self, op, us):
+        entry = self.ops.get(op)
+        if entry is None:
+            entry = [0, 0, 0, [0] * (len(hist_edges) + 1)]
+            self.ops[op] = entry
+        entry[0] += 1
+        entry[1] += us
+        if us > entry[2]:
+            entry[2] = us
+        hist = entry[3]
+        for i, edge in enumerate(hist_edges):
+            if us <= edge:
+                hist[i] += 1
+                return
+        hist[-1] += 1
+
+    ########################
+    #
+    # Reporting
+    #
+    ########################
+
+    def report(self):
+        # everything collected so far, as plain dicts and lists
+        ops = {}
+        for op, (calls, total, max_us, hist) in self.ops.items():
+            ops[op] = {"calls": calls, "total_us": total, "mean_us": total / calls, "max_us": max_us,
+                       "hist": list(hist), "reads": 0, "writes": 0, "bytes": 0, "bus_us": 0}
+        regs = []
+        totals = {"reads": 0, "writes": 0, "bytes": 0, "bus_us": 0}
+        for (op, reg), (reads, writes, rbytes, wbytes, us) in self.regs.items():
+            regs.append({"op": op, "reg": reg, "reads": reads, "writes": writes,
+                         "read_bytes": rbytes, "write_bytes": wbytes, "bus_us": us})
+            if op not in ops:
+                ops[op] = {"calls": 0, "reads": 0, "writes": 0, "bytes": 0, "bus_us": 0}
+            for entry in (ops[op], totals):
+                entry["reads"] += reads
+                entry["writes"] += writes
+                entry["bytes"] += rbytes + wbytes
+                entry["bus_us"] += us
+        regs.sort(key=lambda r: (r["op"], r["reg"]))
+        return {"totals": totals, "ops": ops, "regs": regs, "hist_edges_us": list(hist_edges)}
+
+    def show(self, reg_names=None):
+        if reg_names is None:
+            reg_names = register_names(self.fusb)
+        r = self.report()
+        t = r["totals"]
+        print("{} reads, {} writes, {} bytes, {} us on the bus".format(t["reads"], t["writes"], t["bytes"], t["bus_us"]))
+        print()
+        print("{:16} {:>7} {:>7} {:>7} {:>8} {:>10} {:>10} {:>10}".format(
+              "operation", "calls", "reads", "writes", "bytes", "bus us", "mean us", "max us"))
+        ops = sorted(r["ops"].items(), key=lambda item: -item[1]["bus_us"])
+        for op, o in ops:
+            print("{:16} {:7} {:7} {:7} {:8} {:10} {:>10} {:>10}".format(
+                  op, o["calls"], o["reads"], o["writes"], o["bytes"], o["bus_us"],
+                  "{:.1f}".format(o["mean_us"]) if o["calls"] else "-", o.get("max_us", "-")))
+        print()
+        print("{:16} {:12} {:>7} {:>7} {:>8} {:>8} {:>10}".format(
+              "operation", "register", "reads", "writes", "rd bytes", "wr bytes", "bus us"))
+        for e in r["regs"]:
+            print("{:16} {:12} {:7} {:7} {:8} {:8} {:10}".format(
+                  e["op"], reg_names.get(e["reg"], hex(e["reg"])), e["reads"], e["writes"],
+                  e["read_bytes"], e["write_bytes"], e["bus_us"]))
+        print()
+        print("latency histograms, calls per bucket (us):")
+        labels = ["<={}".format(edge) for edge in hist_edges] + [">{}".format(hist_edges[-1])]
+        for op, o in ops:
+            if not o["calls"]:
+                continue
+            buckets = ["{} {}".format(label, n) for label, n in zip(labels, o["hist"]) if n]
+            print("{:16} {}".format(op, ", ".join(buckets)))
+
+def register_names(fusb):
+    # REG_SWITCHES0 -> "SWITCHES0", from the FUSB302 class constants
+    names = {}
+    for name in dir(type(fusb)):
+        if name.startswith("REG_"):
+            names[getattr(fusb, name)] = name[4:]
+    return names
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Connects a source and a sink stack together through two virtual FUSB302s (see fusbsim.py),
+# so that both ends of a contract can be run against each other in one process, no lab bench needed.
+# Run it to benchmark whole negotiations:
+#
+#     python3 loopback.py -n 200
+#
+# By default, sleep() and ticks_ms() in the stack are replaced by a virtual clock,
+# so that the numbers reflect the stack's own work rather than the delays the spec asks for.
+
+import argparse
+import json
+import sys
+import time
+
+from machine import Pin, I2C
+from fusb302 import FUSB302
+from pdstacc import PDStacc
+from pdsm import SourceStateMachine, SinkStateMachine
+from fusbsim import VirtualFUSB302, REG_SWITCHES0, REG_CONTROL0, REG_INTERRUPTA, I_HARDRST
+from i2cprof import BusProfiler
+from compat import Null
+import fusb302
+import pdstacc
+import pdsm
+
+########################
+#
+# Virtual CC link
+#
+########################
+
+class CCLink():
+    # a CC wire between two VirtualFUSB302s: whatever one of them transmits gets received by the other,
+    # and GoodCRCs come back the same way, courtesy of the receiving FUSB's AUTO_CRC
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        a.tx_cb = self.a_to_b
+        b.tx_cb = self.b_to_a
+        self.attached = False
+        # messages that went over the wire, GoodCRCs included
+        self.messages = 0
+
+    def a_to_b(self, sop, message):
+        return self.deliver(self.b, sop, message)
+
+    def b_to_a(self, sop, message):
+        return self.deliver(self.a, sop, message)
+
+    def deliver(self, dst, sop, message):
+        if not self.attached:
+            return False
+        self.messages += 1
+        if sop == "Hard_Reset":
+            dst.interrupt(REG_INTERRUPTA, I_HARDRST)
+            return True
+        return dst.receive(sop, message)
+
+    def cc_level(self, v):
+        # the end with its pullups on is the source, and its host current setting is what both ends measure
+        if v.regs[REG_SWITCHES0] & 0b11000000:
+            return (v.regs[REG_CONTROL0] >> 2) & 0b11
+        return 0
+
+    def attach(self, cc=1):
+        level = self.cc_level(self.a) or self.cc_level(self.b)
+        self.attached = True
+        self.a.attach(cc, level)
+        self.b.attach(cc, level)
+
+    def detach(self):
+        self.attached = False
+        self.a.detach()
+        self.b.detach()
+
+########################
+#
+# Virtual time
+#
+########################
+
+class VirtualClock():
+    # stands in for sleep() and ticks_ms() in the stack modules; time only moves when something sleeps
+    modules = (pdstacc, fusb302, pdsm)
+
+    def __init__(self):
+        self.now = 0.0
+        self.saved = []
+
+    def sleep(self, s):
+        self.now += s
+
+    def ticks_ms(self):
+        return int(self.now * 1000)
+
+    def install(self):
+        for module in self.modules:
+            for name in ("sleep", "ticks_ms"):
+                if hasattr(module, name):
+                    self.saved.append((module, name, getattr(module, name)))
+                    setattr(module, name, getattr(self, name))
+            if hasattr(module, "ticks_diff"):
+                self.saved.append((module, "ticks_diff", module.ticks_diff))
+                module.ticks_diff = lambda a, b: a - b
+
+    def uninstall(self):
+        for module, name, value in reversed(self.saved):
+            setattr(module, name, value)
+        self.saved = []
+
+########################
+#
+# Benchmark
+#
+########################
+
+class IntPin(Pin):
+    # int_p toggles on every interrupt, no need to remember all of that
+    history = 16
+
+def make_stack(shadow=False, **kwargs):
+    # kwargs go to PDStacc, e.g. irq=True or burst=True
+    i2c = I2C(sda=Pin(18), scl=Pin(19), id=1, freq=400000)
+    int_p = IntPin(20, Pin.IN, Pin.PULL_UP)
+    vfusb = VirtualFUSB302(int_p=int_p)
+    i2c.attach(vfusb)
+    stacc = PDStacc(FUSB302(i2c, int_p=int_p, shadow=shadow), **kwargs)
+    return vfusb, stacc
+
+def make_source(psu_advertisement=None, **kwargs):
+    vfusb, stacc = make_stack(**kwargs)
+    if psu_advertisement is None:
+        psu_advertisement = stacc.create_pdo('fixed', 5000, 1500, 0, 8) + \
+                            stacc.create_pdo('fixed', 20000, 3000, 0, 0)
+    stacc.validate_profile_cb = lambda profile, d: profile in range(len(psu_advertisement)//4)
+    stacc.switch_to_profile_cb = lambda profile, d: None
+    stacc.set_5v_power_rail_cb = lambda: None
+    return vfusb, stacc, SourceStateMachine(stacc, psu_advertisement)
+
+def select_highest_voltage(pdos):
+    # fixed PDO with the highest voltage, at its maximum current
+    best = None
+    for i, pdo in enumerate(pdos):
+        if pdo[0] == 'fixed' and (best is None or pdo[1] > pdos[best][1]):
+            best = i
+    return best, pdos[best][2]
+
+def make_sink(select_pdo=select_highest_voltage, **kwargs):
+    vfusb, stacc = make_stack(**kwargs)
+    stacc.select_pdo = select_pdo
+    stacc.process_accept_cb = lambda d: None
+    return vfusb, stacc, SinkStateMachine(stacc)
+
+def step_until(machines, states, clock, step_s=0.001, max_steps=100000):
+    # steps both machines in turns until they're in the given states; returns the number of rounds
+    for i in range(max_steps):
+        if all([m.state == s for m, s in zip(machines, states)]):
+            return i
+        for m in machines:
+            m.step()
+        if clock is not None:
+            clock.sleep(step_s)
+        else:
+            time.sleep(step_s)
+    raise RuntimeError("stuck in states {}, expected {}".format([m.state for m in machines], states))
+
+def run(n=100, realtime=False, quiet=True, cc=1, profile=False, irq=False, burst=False, shadow=False):
+    # runs n attach-negotiate-detach cycles, returns a dict with the results
+    # (and the BusProfilers for both ends, if profile is set).
+    # irq and burst get passed to both PDStaccs, shadow to both FUSB302s
+    clock = None if realtime else VirtualClock()
+    stdout = sys.stdout
+    if clock is not None:
+        clock.install()
+    if quiet:
+        sys.stdout = Null()
+    try:
+        src_v, src_stacc, src = make_source(irq=irq, burst=burst, shadow=shadow)
+        snk_v, snk_stacc, snk = make_sink(irq=irq, burst=burst, shadow=shadow)
+        link = CCLink(src_v, snk_v)
+        machines = (src, snk)
+        profilers = {}
+        if profile:
+            profilers["source"] = BusProfiler(src_stacc.fusb, src_stacc)
+            profilers["sink"] = BusProfiler(snk_stacc.fusb, snk_stacc)
+        src_stacc.init_fusb()
+        snk_stacc.init_fusb()
+        src.start()
+        snk.start()
+        for p in profilers.values():
+            p.enable()
+        times = []
+        virtual_times = []
+        transactions = []
+        messages = []
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for i in range(n):
+            bus_before = src_v.reads + src_v.writes + snk_v.reads + snk_v.writes
+            link_before = link.messages
+            t = time.perf_counter()
+            vt = clock.now if clock is not None else 0
+            link.attach(cc)
+            step_until(machines, ("ready", "ready"), clock)
+            times.append(time.perf_counter() - t)
+            if clock is not None:
+                virtual_times.append(clock.now - vt)
+            transactions.append(src_v.reads + src_v.writes + snk_v.reads + snk_v.writes - bus_before)
+            messages.append(link.messages - link_before)
+            link.detach()
+            step_until(machines, ("unattached", "unattached"), clock)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        for p in profilers.values():
+            p.disable()
+    finally:
+        sys.stdout = stdout
+        if clock is not None:
+            clock.uninstall()
+    results = {
+        "negotiations": n,
+        "elapsed_s": elapsed,
+        "cpu_s": cpu,
+        "negotiations_per_s": n / elapsed,
+        "attach_to_ps_rdy_ms": summary([t*1000 for t in times]),
+        "bus_transactions_per_contract": summary(transactions),
+        "messages_per_contract": summary(messages),
+        "realtime": realtime,
+        "irq": irq,
+        "burst": burst,
+        "shadow": shadow,
+    }
+    if virtual_times:
+        # how long the negotiation would've taken with the stack's sleeps and timeouts included
+        results["virtual_attach_to_ps_rdy_ms"] = summary([t*1000 for t in virtual_times])
+    if profilers:
+        results["bus_profile"] = {side: p.report() for side, p in profilers.items()}
+    return results, profilers
+
+def summary(values):
+    values = sorted(values)
+    return {"mean": sum(values) / len(values), "min": values[0], "median": values[len(values)//2], "max": values[-1]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark source-sink negotiations over a virtual CC link")
+    parser.add_argument("-n", "--negotiations", type=int, default=100, help="attach-negotiate-detach cycles to run (default: 100)")
+    parser.add_argument("-r", "--realtime", action="store_true", help="keep the stack's real sleeps and timeouts")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the stack's output")
+    parser.add_argument("-j", "--json", action="store_true", help="print results as JSON")
+    parser.add_argument("-p", "--profile", action="store_true", help="profile I2C traffic by operation (see i2cprof.py)")
+    parser.add_argument("--irq", action="store_true", help="run the stacks in irq mode, PDStacc(..., irq=True)")
+    parser.add_argument("--burst", action="store_true", help="drain the FIFO in burst reads, PDStacc(..., burst=True)")
+    parser.add_argument("--shadow", action="store_true", help="cache configuration registers, FUSB302(..., shadow=True)")
+    args = parser.parse_args(argv)
+    results, profilers = run(args.negotiations, realtime=args.realtime, quiet=not args.verbose, profile=args.profile,
+                             irq=args.irq, burst=args.burst, shadow=args.shadow)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{} negotiations in {:.3f}s ({:.3f}s CPU), {:.1f} negotiations/s".format(
+        results["negotiations"], results["elapsed_s"], results["cpu_s"], results["negotiations_per_s"]))
+    for key in ("attach_to_ps_rdy_ms", "virtual_attach_to_ps_rdy_ms", "bus_transactions_per_contract", "messages_per_contract"):
+        if key in results:
+            r = results[key]
+            print("{}: mean {:.3f}, min {:.3f}, median {:.3f}, max {:.3f}".format(key, r["mean"], r["min"], r["median"], r["max"]))
+    for side, p in profilers.items():
+        print()
+        print("# {} bus profile".format(side))
+        p.show()
+
+if __name__ == "__main__":
+    main()
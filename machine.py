@@ -4,10 +4,13 @@ base class that records a series of state changes described as PinEvents. Pin, P
 extend StateTrackable.
 """
 
-from mock import Mock
 import time
-time.ticks_us = Mock()
-time.ticks_diff = Mock()
+from collections import deque
+
+def idle():
+    # on the MCU, this returns on the next interrupt - the system tick at the latest
+    time.sleep(0.001)
+
 
 class PinEvent:
     def __init__(self, old_value, new_value):
@@ -23,8 +26,12 @@ class PinEvent:
 
 
 class StateTrackable:
+    # how many events to keep, None keeps all of them; keeps memory flat during long simulations.
+    # the event deque gets sized in __init__, so set this on the class (or a subclass) beforehand
+    history = None
+
     def __init__(self):
-        self.events = []
+        self.events = deque(maxlen=self.history)
         self.event_id = 1
 
     def record_event(self, event: PinEvent):
@@ -33,9 +40,11 @@ class StateTrackable:
         self.event_id += 1
 
     def get_event(self, event_id: int) -> PinEvent:
-        for e in self.events:
-            if e.event_id == event_id:
-                return e
+        # IDs are sequential, so the event's position follows from its ID.
+        # returns None for events that fell out of the history
+        i = event_id - (self.event_id - len(self.events))
+        if 0 <= i < len(self.events):
+            return self.events[i]
 
     def __str__(self):
         return "{}".format(self.events)
@@ -75,7 +84,7 @@ class Pin(StateTrackable):
             if event.old_value is None or event.new_value > event.old_value:
                 self.irq_rising_handler(self)
         if self.irq_falling_handler is not None:
-            if event.new_value is not None and event.new_value < event.old_value:
+            if event.new_value is not None and event.old_value is not None and event.new_value < event.old_value:
                 self.irq_falling_handler(self)
 
     def irq(self, handler, trigger: int = (IRQ_FALLING | IRQ_RISING | OPEN_DRAIN), priority: int = 1,
@@ -115,30 +124,33 @@ class BusMessageGenerator:
 
     def __init__(self):
         self._messages = {}
+        self._counts = {}
 
     def add(self, message: bytes, addr: int = 0x00):
         if addr not in self._messages:
-            self._messages[addr] = list()
+            self._messages[addr] = deque()
+            self._counts[addr] = 0
+        self._counts[addr] += 1
         bus_message = BusMessage(payload=message)
-        bus_message.set_message_id(len(self._messages[addr]) + 1)
+        bus_message.set_message_id(self._counts[addr])
         self._messages[addr].append(bus_message)
 
     def next(self, addr: int = 0x00) -> bytes:
-        # in lieu of shift()...
-        self._messages[addr].reverse()
-        first = self._messages[addr].pop()
-        self._messages[addr].reverse()
-        return first
+        return self._messages[addr].popleft()
 
     def has_next(self, addr: int = 0x00) -> bool:
-        return len(self._messages[addr]) > 0
+        return len(self._messages.get(addr, ())) > 0
 
 
 class Bus:
+    # how many recorded messages to keep per address, None keeps all of them.
+    # a deque gets sized when an address is first written to, so set this before that happens
+    history = None
 
     def __init__(self):
         self._generator = BusMessageGenerator()
         self._messages = {}
+        self._next_id = {}
 
     @property
     def generator(self) -> BusMessageGenerator:
@@ -147,21 +159,24 @@ class Bus:
     def get_current_message(self, addr: int = 0x00) -> BusMessage:
         if addr not in self._messages:
             raise Exception("No messages yet for {}", addr)
-        max_id = len(self._messages[addr])
-        return self.get_message(addr, max_id)
+        return self._messages[addr][-1]
 
     def record_message(self, message, addr:int = 0x00) -> None:
         if addr not in self._messages:
-            self._messages[addr] = list()
-        max_id = len(self._messages[addr])
+            self._messages[addr] = deque(maxlen=self.history)
+            self._next_id[addr] = 1
         bus_message = BusMessage(message)
-        bus_message.set_message_id(max_id + 1)
+        bus_message.set_message_id(self._next_id[addr])
+        self._next_id[addr] += 1
         self._messages[addr].append(bus_message)
 
     def get_message(self, message_id: int, addr: int = 0x00):
-        for message in self._messages[addr]:
-            if message.message_id == message_id:
-                return message
+        # IDs are sequential, so the message's position follows from its ID.
+        # returns None for messages that fell out of the history
+        messages = self._messages[addr]
+        i = message_id - (self._next_id[addr] - len(messages))
+        if 0 <= i < len(messages):
+            return messages[i]
 
 
 class SPI(Bus):
@@ -231,9 +246,18 @@ class I2C(Bus):
         self.scl = scl
         self.sda = sda
         self.freq = freq
+        self.devices = {}
+
+    """Put a device model on the bus, so that memory reads and writes to its address go to it instead of returning
+    zeroes. The model needs an addr attribute (unless addr is given) and read_mem(memaddr, nbytes)/write_mem(memaddr, buf)
+    methods, like fusbsim.VirtualFUSB302."""
+    def attach(self, device, addr: int = None):
+        if addr is None:
+            addr = device.addr
+        self.devices[addr] = device
 
     def scan(self):
-        return []
+        return sorted(self.devices)
 
     '''Read nbytes from the peripheral specified by addr. If stop is true then a STOP condition is generated at the end of the transfer.
        Returns a bytes object with the data read.'''
@@ -285,6 +309,9 @@ class I2C(Bus):
     """Read nbytes from the peripheral specified by addr starting from the memory address specified by memaddr. 
     The argument addrsize specifies the address size in bits. Returns a bytes object with the data read."""
     def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        device = self.devices.get(addr)
+        if device is not None:
+            return device.read_mem(memaddr, nbytes)
         return bytearray(100)
         raise NotImplementedError('readfrom_mem')
 
@@ -293,12 +320,19 @@ class I2C(Bus):
     (on ESP8266 this argument is not recognised and the address size is always 8 bits).
     The method returns None."""
     def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        device = self.devices.get(addr)
+        if device is not None:
+            buf[:] = device.read_mem(memaddr, len(buf))
+            return
         raise NotImplementedError('readfrom_mem_into')
 
     """Write buf to the peripheral specified by addr starting from the memory address specified by memaddr. 
     The argument addrsize specifies the address size in bits (on ESP8266 this argument is not recognised and the address size is always 8 bits).
     The method returns None."""
     def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        device = self.devices.get(addr)
+        if device is not None:
+            device.write_mem(memaddr, buf)
         return
         raise NotImplementedError('writeto_mem')
 
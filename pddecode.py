@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Batch decoder for captures made with sniffer.py (see capture.py for the format).
+# Decodes whole directories of captures in parallel, one file per worker process,
+# and writes one JSON line per file with message counts and decode errors.
+#
+# usage: pddecode.py [-j JOBS] [--messages] [--summary] [--dedup] PATH [PATH ...]
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from capture import read_capture, ReplaySource, RetryFilter
+from pdstacc import PDStacc
+
+def find_captures(paths, pattern):
+    # files are taken as-is, directories are searched for files matching the pattern
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if fnmatch.fnmatch(name, pattern):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def message_record(d, ts, cc, retries=0):
+    m = {"ts": ts, "cc": cc, "sop": "SOP" if d.st else "SOP'", "id": d.i, "type": d.tn,
+         "pr": d.pr, "dr": d.dr, "rev": d.r+1, "ext": d.e, "header": "{:02x}{:02x}".format(d.b0, d.b1), "crc_ok": d.crc_ok}
+    if d.dc:
+        m["data"] = bytes(d.d).hex()
+    if d.k == PDStacc.source_caps_key:
+        m["pdos"] = d.pdos
+    if retries:
+        m["retries"] = retries
+    return m
+
+def decode_file(args):
+    path, keep_messages, dedup = args
+    result = {"file": path, "records": 0, "messages": 0, "discarded": 0, "crc_errors": 0, "counts": {}, "errors": []}
+    if keep_messages:
+        result["message_list"] = []
+    counts = result["counts"]
+    errors = result["errors"]
+    stacc = PDStacc(None, history=0)
+    # discarded bytes are counted instead, they'd end up in the middle of the JSON output
+    stacc.show_discarded = False
+    retry_filter = RetryFilter() if dedup else None
+
+    def add(d, ts, cc, retries=0):
+        result["messages"] += 1
+        counts[d.tn] = counts.get(d.tn, 0) + 1
+        if keep_messages:
+            result["message_list"].append(message_record(d, ts, cc, retries))
+
+    try:
+        with open(path, "rb") as f:
+            for n, (ts, cc, data) in enumerate(read_capture(f)):
+                result["records"] += 1
+                # every record is one FIFO readout and can have several messages in it
+                source = ReplaySource(data)
+                stacc.fusb = source
+                while not source.done():
+                    try:
+                        d = stacc.get_message()
+                    except Exception as e:
+                        errors.append({"record": n, "ts": ts, "pos": source.pos, "error": repr(e)})
+                        source.skip_packet()
+                        continue
+                    if d is None:
+                        continue
+                    if retry_filter is None:
+                        add(d, ts, cc)
+                    else:
+                        # released messages can come from earlier records, so they bring their own CC line
+                        for d, retries, first_ts, first_cc in retry_filter.push(d, ts, cc):
+                            add(d, first_ts, first_cc, retries)
+        if retry_filter is not None:
+            for d, retries, first_ts, first_cc in retry_filter.flush():
+                add(d, first_ts, first_cc, retries)
+            result["retries"] = retry_filter.retries
+            result["retries_by_type"] = retry_filter.retries_by_type
+    except OSError as e:
+        errors.append({"error": repr(e)})
+    result["discarded"] = stacc.discarded
+    result["crc_errors"] = stacc.crc_errors
+    return result
+
+def json_default(o):
+    # raw PDO bytes in PDOs we don't parse fully yet
+    return bytes(o).hex()
+
+def write_results(results, out, totals, summary):
+    for result in results:
+        totals["files"] += 1
+        totals["messages"] += result["messages"]
+        totals["errors"] += len(result["errors"])
+        totals["crc_errors"] += result["crc_errors"]
+        if summary:
+            out.write("{}: {} messages, {} errors, {} CRC errors, {} discarded bytes\n".format(result["file"], result["messages"], len(result["errors"]), result["crc_errors"], result["discarded"]))
+            if "retries" in result:
+                out.write("    ({} retries)\n".format(result["retries"]))
+            for name, count in sorted(result["counts"].items()):
+                out.write("    {}: {}\n".format(name, count))
+        else:
+            out.write(json.dumps(result, default=json_default))
+            out.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode USB-PD captures in bulk")
+    parser.add_argument("paths", nargs="+", help="capture files or directories with them")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="worker processes (default: all cores)")
+    parser.add_argument("-p", "--pattern", default="*.bin", help="filename pattern to look for in directories (default: *.bin)")
+    parser.add_argument("-m", "--messages", action="store_true", help="include every decoded message in the output")
+    parser.add_argument("-s", "--summary", action="store_true", help="print a summary table instead of JSON")
+    parser.add_argument("-d", "--dedup", action="store_true", help="collapse hardware retries into one message with a retry count")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    jobs = [(path, args.messages, args.dedup) for path in find_captures(args.paths, args.pattern)]
+    out = open(args.output, "w") if args.output else sys.stdout
+    totals = {"files": 0, "messages": 0, "errors": 0, "crc_errors": 0}
+    try:
+        if args.jobs > 1 and len(jobs) > 1:
+            # the pool gets shut down even if writing the results fails halfway
+            with Pool(args.jobs) as pool:
+                # ordered, so that the output is the same no matter how many jobs there are
+                results = pool.imap(decode_file, jobs, chunksize=max(1, len(jobs) // (args.jobs*8)))
+                write_results(results, out, totals, args.summary)
+        else:
+            write_results(map(decode_file, jobs), out, totals, args.summary)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("{files} files, {messages} messages, {errors} errors, {crc_errors} CRC errors\n".format(**totals))
+    return 1 if totals["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
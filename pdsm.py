@@ -0,0 +1,221 @@
+from pdstacc import message_keys
+from compat import ticks_ms, ticks_diff
+
+########################
+#
+# State machine engine
+#
+########################
+
+class StateMachine():
+    """
+    Runs a PDStacc through a table of states. Each state is a dict with these (optional) keys:
+
+    - "enter": method called when the state is entered
+    - "poll": (method, next state) - called on every step instead of receiving messages,
+      the machine moves to the next state once it returns something truthy
+    - "messages": {message name: (method or None, next state or None)}, turned into a list indexed by message key
+    - "timeout": (ms, method or None, next state) - fires if nothing else moved us out of the state
+
+    `any_state` has message handlers that apply in all states, unless overridden by the state itself.
+    Methods are named by string and get looked up on the state machine first, then on the PDStacc,
+    so that the stack's own handlers (sink_source_caps() and friends) get used as they are.
+    Message handlers get the received message as the argument. A handler can return
+    a state name to override the next state from the table; None for next state means "stay here".
+    Entering a state, even the current one, re-runs its "enter" method and restarts its timeout.
+    """
+
+    states = {}
+    any_state = {}
+    initial_state = None
+    # PDStacc method called with interrupt registers, returns True on detach
+    interrupts = None
+    detach_state = None
+
+    # seconds to sleep between steps in run(); in irq mode, run() idles until int_p fires instead
+    poll_interval = 0.00001
+
+    def __init__(self, stacc):
+        self.stacc = stacc
+        self.state = None
+        # tables get resolved into bound methods once, so that dispatch is a single list lookup
+        self.table = {}
+        for name, st in self.states.items():
+            # message handlers go into a list indexed by message key
+            messages = [None]*64
+            for msg_name, (fn, next_state) in self.any_state.items():
+                messages[message_keys[msg_name]] = (self.method(fn), next_state)
+            for msg_name, (fn, next_state) in st.get("messages", {}).items():
+                messages[message_keys[msg_name]] = (self.method(fn), next_state)
+            poll = st.get("poll", None)
+            if poll is not None:
+                poll = (self.method(poll[0]), poll[1])
+            timeout = st.get("timeout", None)
+            if timeout is not None:
+                timeout = (timeout[0], self.method(timeout[1]), timeout[2])
+            self.table[name] = (self.method(st.get("enter", None)), poll, messages, timeout)
+        self.interrupts_fn = getattr(stacc, self.interrupts)
+
+    def method(self, name):
+        if name is None:
+            return None
+        fn = getattr(self, name, None)
+        if fn is None:
+            fn = getattr(self.stacc, name)
+        return fn
+
+    def goto(self, state):
+        self.state = state
+        self.entered = ticks_ms()
+        enter = self.table[state][0]
+        if enter is not None:
+            enter()
+
+    def start(self):
+        self.goto(self.initial_state)
+
+    def step(self):
+        # does one round of work in the current state, doesn't block
+        enter, poll, messages, timeout = self.table[self.state]
+        if poll is not None:
+            fn, next_state = poll
+            if fn():
+                self.goto(next_state)
+            return
+        stacc = self.stacc
+        rx, i = stacc.poll()
+        while rx:
+            d = stacc.get_message()
+            if d is None: # only padding was left, get_message() dropped it
+                break
+            stacc.packets.append(d)
+            self.dispatch(d)
+            stacc.show_msg(d)
+            stacc.print_sent()
+            rx = stacc.rx_pending()
+        if i is not None and self.interrupts_fn(i):
+            self.goto(self.detach_state)
+            return
+        timeout = self.table[self.state][3]
+        if timeout is not None:
+            ms, fn, next_state = timeout
+            if ticks_diff(ticks_ms(), self.entered) >= ms:
+                if fn is not None:
+                    fn()
+                self.goto(next_state)
+
+    def dispatch(self, d):
+        handler = self.table[self.state][2][d.k]
+        if handler is None:
+            return
+        fn, next_state = handler
+        if fn is not None:
+            next_state = fn(d) or next_state
+        if next_state is not None:
+            self.goto(next_state)
+
+    def run(self):
+        self.start()
+        while True:
+            self.step()
+            self.stacc.wait(self.poll_interval) # so that ctrlc works
+
+########################
+#
+# Sink and source tables
+#
+########################
+
+class SinkStateMachine(StateMachine):
+    states = {
+        "unattached": {"enter": "detached", "poll": ("wait_attach", "wait_caps")},
+        "wait_caps": {},
+        "wait_accept": {
+            "messages": {"Accept": ("sink_accept", "wait_ps_rdy"),
+                         "Reject": (None, "wait_caps"),
+                         "Wait": (None, "wait_caps")},
+            "timeout": (500, None, "wait_caps")},
+        "wait_ps_rdy": {
+            "messages": {"PS_RDY": ("sink_accept", "ready")},
+            "timeout": (600, None, "wait_caps")},
+        "ready": {},
+    }
+    any_state = {
+        # sources can re-send capabilities at any moment, and we have to answer quickly
+        "Source_Capabilities": ("sink_source_caps", "wait_accept"),
+        "Vendor_Defined": ("react_vdm", None),
+    }
+    initial_state = "unattached"
+    interrupts = "sink_interrupts"
+    detach_state = "unattached"
+
+    def start(self):
+        # configuration only happens once; after a detach, we go straight back to waiting for a source
+        self.stacc.configure_sink()
+        StateMachine.start(self)
+
+    def detached(self):
+        self.stacc.pdo_requested = False
+        self.stacc.reset_msg_id()
+
+    def wait_attach(self):
+        cc = self.stacc.fusb.find_cc(fn="measure_sink")
+        if cc:
+            self.stacc.cc = self.stacc.fusb.find_cc(fn="measure_sink", debug=True)
+            return True
+
+
+class SourceStateMachine(StateMachine):
+    states = {
+        "unattached": {"enter": "detached", "poll": ("wait_attach", "attached")},
+        # give the sink a moment after attach before we start talking
+        "attached": {"enter": "attached", "timeout": (300, None, "wait_request")},
+        # keep re-sending the advertisement until we get a Request
+        "wait_request": {
+            "enter": "advertise",
+            "messages": {"Request": ("process_request", "ready")},
+            "timeout": (100, None, "wait_request")},
+        "ready": {"messages": {"Request": ("process_request", None)}},
+    }
+    any_state = {}
+    initial_state = "unattached"
+    interrupts = "source_interrupts"
+    detach_state = "unattached"
+
+    max_advertisements = 30
+
+    def __init__(self, stacc, psu_advertisement):
+        StateMachine.__init__(self, stacc)
+        self.psu_advertisement = psu_advertisement
+
+    def start(self):
+        self.stacc.configure_source()
+        StateMachine.start(self)
+
+    def detached(self):
+        self.stacc.profile_selected = False
+        self.stacc.reset_msg_id()
+        self.advertisement_counter = 0
+        power_off_cb = getattr(self.stacc, "power_off_cb", None)
+        if power_off_cb is not None:
+            power_off_cb()
+
+    def wait_attach(self):
+        cc = self.stacc.fusb.find_cc(fn="measure_source")
+        if cc:
+            self.stacc.cc = self.stacc.fusb.find_cc(fn="measure_source", debug=True)
+            return True
+
+    def attached(self):
+        self.stacc.set_5v_power_rail_cb()
+
+    def advertise(self):
+        if self.advertisement_counter < self.max_advertisements:
+            print("sending advertisement")
+            self.stacc.send_advertisement(self.psu_advertisement)
+            self.advertisement_counter += 1
+
+    def process_request(self, d):
+        if self.stacc.source_request(d) is False:
+            # invalid profile, the sink will have to ask again
+            return "wait_request"
@@ -1,6 +1,16 @@
 from time import sleep
 import sys
 
+from compat import ticks_us, ticks_ms, ticks_diff
+
+try:
+    from binascii import crc32
+except ImportError:
+    try:
+        from ubinascii import crc32
+    except ImportError:
+        crc32 = None
+
 ########################
 #
 # Specification data
@@ -54,6 +64,277 @@ data_message_types = [
     "Vendor_Defined",
 ]
 
+########################
+#
+# Received messages
+#
+########################
+
+class PDMessage():
+    # a received message, backed by the raw header and payload bytes.
+    # nothing gets decoded until it's accessed: header fields are cheap properties,
+    # while the name, PDOs and VDM fields are only worked out when somebody asks for them.
+    # it can still be used like the dict that get_message() used to return,
+    # so d["t"], d.get("vdm_o") and friends keep working in callbacks
+    __slots__ = (
+        "o", # outgoing message if True
+        "h", # FIFO token byte
+        "b0", "b1", # header bytes
+        "d", # data objects (bytes), not set for control messages
+        "s", # PDStacc that received the message, does the heavier decoding
+        "vp", # whether the VDM fields have been parsed
+        "pd", # parsed PDOs, once asked for
+        "crc_ok", # whether the received CRC matched, None if it wasn't checked
+        "extra", # dict for keys callbacks add that aren't fields, None until there's one
+        # VDM fields, set by PDStacc.parse_vdm()
+        "vdm_s", "vdm_sv", "vdm_svn", "vdm_v", "vdm_o", "vdm_ct", "vdm_c", "vdm_cn", "vdm_d",
+    )
+
+    def __init__(self, h, b1, b0, s=None, o=False):
+        self.o = o
+        self.h = h
+        self.b1 = b1
+        self.b0 = b0
+        self.s = s
+        self.vp = False
+        self.pd = None
+        self.crc_ok = None
+        self.extra = None
+
+    @property
+    def st(self): # 1 if SOP, 0 if SOP'
+        return 1 if self.h == 0xe0 else 0
+
+    @property
+    def pr(self): # power role
+        return self.b0 & 1
+
+    @property
+    def dr(self): # data role
+        return self.b1 >> 5 & 1
+
+    @property
+    def t(self): # message type
+        return self.b1 & 0b11111
+
+    @property
+    def dc(self): # data object count
+        return (self.b0 >> 4) & 0b111
+
+    @property
+    def c(self): # control if True else data
+        return (self.b0 & 0b1110000) == 0
+
+    @property
+    def i(self): # message ID
+        return (self.b0 >> 1) & 0b111
+
+    @property
+    def r(self): # spec revision
+        return self.b1 >> 6
+
+    @property
+    def e(self): # extended
+        return self.b0 >> 7
+
+    @property
+    def k(self): # message key, indexes message_names and dispatch tables
+        return (self.b1 & 0b11111) | (MSG_DATA if self.b0 & 0b1110000 else 0)
+
+    @property
+    def tn(self): # message type name
+        return message_names[self.k]
+
+    @property
+    def pdos(self): # parsed capability PDOs
+        if self.pd is None:
+            self.pd = self.s.get_pdos(self)
+        return self.pd
+
+    def __getattr__(self, key):
+        # only called for fields that haven't been set yet;
+        # VDM fields get parsed the first time any of them is needed
+        if not self.vp and key.startswith("vdm_") and self.k == PDStacc.vdm_key:
+            self.vp = True
+            self.s.parse_vdm(self)
+            return getattr(self, key)
+        extra = self.extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise AttributeError(key)
+
+    # dict compatibility
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        # callbacks used to be able to put anything into the message dict, so they still can
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            if key in self.fields:
+                # header fields are decoded from b0/b1 on every access
+                raise AttributeError("{} is read-only, set b0/b1 instead".format(key))
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    fields = ("o", "h", "b0", "b1", "st", "pr", "dr", "dc", "t", "c", "k", "i", "d", "r", "e", "tn", "crc_ok",
+              "vdm_s", "vdm_sv", "vdm_svn", "vdm_v", "vdm_o", "vdm_ct", "vdm_c", "vdm_cn", "vdm_d")
+
+    def keys(self):
+        keys = [key for key in self.fields if hasattr(self, key)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def to_dict(self):
+        return {key:getattr(self, key) for key in self.keys()}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+# all message types in one table, indexed by message key:
+# the 5-bit type number, plus 0x20 for data messages. unassigned types are "Reserved"
+MSG_DATA = 0x20
+
+message_names = ["Reserved"]*64
+for i, name in enumerate(control_message_types):
+    message_names[i] = name
+for i, name in enumerate(data_message_types):
+    message_names[MSG_DATA | i] = name
+
+# message name to key, for building dispatch tables
+message_keys = {}
+for i, name in enumerate(message_names):
+    if name != "Reserved":
+        message_keys[name] = i
+
+########################
+#
+# CRC
+#
+########################
+
+# USB-PD uses the same CRC-32 as Ethernet, sent little-endian after the message.
+# binascii.crc32 does it in C where available, otherwise it's done with a table
+if crc32 is None:
+    crc_table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = (c >> 1) ^ 0xedb88320 if c & 1 else c >> 1
+        crc_table.append(c)
+
+    def crc32(data, crc=0):
+        crc ^= 0xffffffff
+        for b in data:
+            crc = crc_table[(crc ^ b) & 0xff] ^ (crc >> 8)
+        return crc ^ 0xffffffff
+
+########################
+#
+# Message history
+#
+########################
+
+class History():
+    # fixed-size ring of the most recent entries.
+    # the storage is allocated once, so memory use stays flat no matter how long we run.
+    # depth of 0 disables it, with append() doing nothing
+    def __init__(self, depth):
+        self.depth = depth
+        self.entries = [None]*depth
+        self.pos = 0 # where the next entry goes
+        self.count = 0
+
+    def append(self, entry):
+        depth = self.depth
+        if not depth:
+            return
+        pos = self.pos
+        self.entries[pos] = entry
+        pos += 1
+        self.pos = 0 if pos == depth else pos
+        if self.count < depth:
+            self.count += 1
+
+    def clear(self):
+        # only the slots in use get dropped, so that clearing an empty history costs nothing
+        depth = self.depth
+        pos = self.pos
+        for i in range(self.count):
+            pos = pos - 1 if pos else depth - 1
+            self.entries[pos] = None
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # oldest to newest
+        depth = self.depth
+        start = self.pos - self.count
+        for i in range(self.count):
+            yield self.entries[(start + i) % depth]
+
+    def __getitem__(self, i):
+        # 0 is the oldest entry, -1 is the newest
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.entries[(self.pos - self.count + i) % self.depth]
+
+    def recent(self, n=None):
+        # list of the most recent n entries, oldest first
+        if n is None or n > self.count:
+            n = self.count
+        return [self[i] for i in range(self.count - n, self.count)]
+
+class LRUCache():
+    # small mapping that forgets the least recently used entry once it's full.
+    # meant for a handful of entries, so plain lists are good enough for the ordering
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.order = [] # least recently used first
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        order = self.order
+        if order[-1] != key:
+            order.remove(key)
+            order.append(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.entries[self.order.pop(0)]
+        self.entries[key] = value
+        self.order.append(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.order.clear()
+
+    def __len__(self):
+        return len(self.order)
+
 ########################
 #
 # USB-C stacc code
@@ -64,25 +345,73 @@ class PDStacc():
     pdo_requested = False
     pdos = []
 
-    sent_messages = []
+    # how many sent messages can queue up for print_sent()
+    sent_depth = 8
 
     # set to -1 because it's incremented before each command is sent out
     msg_id = -1
 
-    def __init__(self, fusb):
+    # FUSB method used to read the RX FIFO
+    rxb_fn = "get_rxb"
+
+    # whether we wait for int_p interrupts instead of polling the FUSB
+    irq_mode = False
+
+    # how often the source re-sends its advertisement until a profile is selected, in seconds
+    advertisement_interval = 0.1
+
+    # message handlers for the sink and source flows, by message name.
+    # these get turned into tables indexed by message key, anything not listed goes to ignore_message()
+    sink_handlers = {
+        "Source_Capabilities": "sink_source_caps",
+        "Accept": "sink_accept",
+        "PS_RDY": "sink_accept",
+        "Vendor_Defined": "react_vdm",
+    }
+    source_handlers = {
+        "GoodCRC": "source_goodcrc",
+        "Request": "source_request",
+    }
+
+    # how many different Source_Capabilities to remember the decoding of
+    caps_cache_size = 4
+
+    # set to True if select_pdo only depends on the PDOs it's given, and its result can be cached
+    # along with them. off by default, since policies like the examples' read globals (expected_voltage)
+    pure_select_pdo = False
+
+    def __init__(self, fusb, burst=False, irq=False, history=32):
         self.fusb = fusb
+        # raw PDO bytes -> [parsed PDO list, select_pdo() result, select_pdo used for it]
+        self.caps_cache = LRUCache(self.caps_cache_size)
+        self.build_vdm_replies()
+        self.sink_table = self.handler_table(self.sink_handlers)
+        self.source_table = self.handler_table(self.source_handlers)
+        # received and sent messages, most recent `history` of them; 0 disables it
+        self.packets = History(history)
+        self.sent_messages = History(self.sent_depth)
+        if burst:
+            # drain the FIFO in one read and parse messages from memory; the FUSB only gets
+            # drained once a message has come in in full, see FUSB302.get_rxb_burst()
+            self.rxb_fn = "get_rxb_burst"
+        if irq:
+            self.irq_mode = True
+            self.fusb.enable_irq()
 
     def init_fusb(self):
         self.fusb.reset()
         self.fusb.power()
         self.fusb.unmask_all()
 
-    def setup_sink(self):
+    def configure_sink(self):
         #self.fusb.enable_pulldowns()
         self.fusb.set_controls_sink()
         self.fusb.set_roles()
         self.fusb.set_wake(True)
         self.fusb.set_mdac(0b100)
+
+    def setup_sink(self):
+        self.configure_sink()
         cc = 0
         cc = self.fusb.find_cc(fn="measure_sink", debug=True)
         while cc == 0:
@@ -100,13 +429,16 @@ class PDStacc():
         self.fusb.flush_receive()
         self.fusb.reset_pd()
 
-    def setup_source(self):
+    def configure_source(self):
         self.fusb.set_controls_source()
         self.fusb.set_roles(power_role=1)
         self.fusb.disable_pulldowns()
         self.fusb.set_wake(True)
         self.fusb.enable_pullups()
         self.fusb.set_mdac(0b111111)
+
+    def setup_source(self):
+        self.configure_source()
         cc = self.fusb.find_cc(fn="measure_source", debug=True)
         while cc == 0:
             cc = self.fusb.find_cc(fn="measure_source")
@@ -122,145 +454,198 @@ class PDStacc():
     def reset_msg_id(self):
         self.msg_id = -1
 
-    packets = []
+    def rx_pending(self):
+        # whether there's a message waiting for us, either already read out or in the FIFO
+        return self.fusb.rx_buffered() or self.fusb.rxb_state()[0] == 0
+
+    def poll(self):
+        # checks if the FUSB has anything for us
+        # returns (whether there's a message waiting, interrupt registers or None)
+        if self.irq_mode:
+            # the bus is only touched once the FUSB has pulled int_p low
+            if not self.fusb.int_flag:
+                return self.fusb.rx_buffered(), None
+            self.fusb.int_flag = False
+            i = self.fusb.interrupts()
+            return self.rx_pending(), i
+        rx = self.rx_pending()
+        i = self.fusb.interrupts() if self.fusb.int_p.value() == 0 else None
+        return rx, i
+
+    def wait(self, timeout):
+        # between polls: in irq mode, idles until the FUSB has something for us,
+        # otherwise sleeps for `timeout` seconds
+        if self.irq_mode:
+            if not self.fusb.rx_buffered():
+                self.fusb.wait_int()
+        else:
+            sleep(timeout)
 
     def flow_source(self, psu_advertisement):
-        counter = 0
         advertisement_counter = 1
         self.reset_msg_id()
         sleep(0.3)
         print("sending advertisement")
         self.send_advertisement(psu_advertisement)
+        advertised = ticks_ms()
         self.profile_selected = False
         try:
             timeout = 0.00001
             while True:
-                if self.fusb.rxb_state()[0] == 0: # buffer non-empty
-                    d = get_message()
+                rx, i = self.poll()
+                while rx: # buffer non-empty
+                    d = self.get_message()
+                    if d is None: # only padding was left, get_message() dropped it
+                        break
                     self.packets.append(d)
-                    msg_types = control_message_types if d["c"] else data_message_types
-                    msg_name = msg_types[d["t"]]
-                    # now we do things depending on the message type that we received
-                    if msg_name == "GoodCRC": # example
-                        print("GoodCRC")
-                    elif msg_name == "Request":
-                        self.profile_selected = True
-                        self.process_psu_request(psu_advertisement, d)
-                    self.show_msg(d)
-                for message in self.sent_messages:
-                    sys.stdout.write('> ')
-                    sys.stdout.write(myhex(message))
-                    sys.stdout.write('\n')
-                self.sent_messages = []
-                sleep(timeout) # so that ctrlc works
-                counter += 1
-                if counter == 10000:
-                    counter = 0
+                    self.source_message(d)
+                    rx = self.rx_pending()
+                self.print_sent()
+                self.wait(timeout) # so that ctrlc works
+                if ticks_diff(ticks_ms(), advertised) >= self.advertisement_interval * 1000:
+                    advertised = ticks_ms()
                     if not self.profile_selected and advertisement_counter < 30:
                         print("sending advertisement")
                         self.send_advertisement(psu_advertisement)
                         advertisement_counter += 1
-                if self.fusb.int_p.value() == 0:
-                    i = self.fusb.interrupts()
-                    print(i)
-                    i_reg = i[2]
-                    if i_reg & 0x80: # I_VBUSOK
-                        print("I_VBUSOK")
-                        #pass # just a side effect of vbus being attached
-                    if i_reg & 0x40: # I_ACTIVITY
-                        print("I_ACTIVITY")
-                        pass # just a side effect of CC comms I think?
-                    if i_reg & 0x20: # I_COMP_CHNG
-                        print("I_COMP_CHNG")
-                        # this is where detach can occur, let's check
-                        cc = self.fusb.find_cc(fn="measure_source")
-                        if cc == 0:
-                            print("Disconnect detected!")
-                            return # we exiting this
-                    if i_reg & 0x10: # I_CRC_CHK
-                        pass # new CRC, just a side effect of CC comms
-                    if i_reg & 0x8: # I_ALERT
-                        print("I_ALERT")
-                        x = self.fusb.bus.readfrom_mem(0x22, 0x41, 1)[0] # TODO export
-                        print(bin(x))
-                    if i_reg & 0x4: # I_WAKE
-                        print("I_WAKE")
-                    if i_reg & 0x2: # I_COLLISION
-                        print("I_COLLISION")
-                    if i_reg & 0x1: # I_BC_LVL
-                        print("I_BC_LVL")
+                if i is not None and self.source_interrupts(i):
+                    return # we exiting this
         except KeyboardInterrupt:
                 print("CtrlC")
                 sleep(1)
                 raise
 
+    def handler_table(self, handlers, default="ignore_message"):
+        # turns {message name: method name} into a list of methods indexed by message key
+        table = [getattr(self, default)]*64
+        for name, fn in handlers.items():
+            table[message_keys[name]] = getattr(self, fn)
+        return table
+
+    def ignore_message(self, d):
+        pass
+
+    def source_message(self, d):
+        # now we do things depending on the message type that we received
+        self.source_table[d.k](d)
+        self.show_msg(d)
+
+    def source_goodcrc(self, d):
+        print("GoodCRC") # example
+
+    def source_request(self, d):
+        self.profile_selected = True
+        return self.process_psu_request(d)
+
+    def source_interrupts(self, i):
+        # returns True if the sink has been disconnected
+        print(i)
+        i_reg = i[2]
+        if i_reg & 0x80: # I_VBUSOK
+            print("I_VBUSOK")
+            #pass # just a side effect of vbus being attached
+        if i_reg & 0x40: # I_ACTIVITY
+            print("I_ACTIVITY")
+            pass # just a side effect of CC comms I think?
+        if i_reg & 0x20: # I_COMP_CHNG
+            print("I_COMP_CHNG")
+            # this is where detach can occur, let's check
+            cc = self.fusb.find_cc(fn="measure_source")
+            if cc == 0:
+                print("Disconnect detected!")
+                return True
+        if i_reg & 0x10: # I_CRC_CHK
+            pass # new CRC, just a side effect of CC comms
+        if i_reg & 0x8: # I_ALERT
+            print("I_ALERT")
+            x = self.fusb.bus.readfrom_mem(0x22, 0x41, 1)[0] # TODO export
+            print(bin(x))
+        if i_reg & 0x4: # I_WAKE
+            print("I_WAKE")
+        if i_reg & 0x2: # I_COLLISION
+            print("I_COLLISION")
+        if i_reg & 0x1: # I_BC_LVL
+            print("I_BC_LVL")
+        return False
+
     def flow_sink(self):
         self.pdo_requested = False # not sure this needs to be here
         self.reset_msg_id()
         try:
             timeout = 0.00001
             while True:
-                if self.fusb.rxb_state()[0] == 0: # buffer non-empty
+                rx, i = self.poll()
+                while rx: # buffer non-empty
                     d = self.get_message()
+                    if d is None: # only padding was left, get_message() dropped it
+                        break
                     self.packets.append(d)
-                    msg_types = control_message_types if d["c"] else data_message_types
-                    msg_name = msg_types[d["t"]]
-                    # now we do things depending on the message type that we received
-                    if msg_name == "GoodCRC": # example
-                        pass # print("GoodCRC")
-                    elif msg_name == "Source_Capabilities":
-                        # need to request a PDO!
-                        self.pdos = self.get_pdos(d)
-                        pdo_i, current = self.select_pdo(self.pdos)
-                        # sending a message, need to increment message id
-                        self.request_fixed_pdo(pdo_i, current, current)
-                        # print("PDO requested!")
-                        self.pdo_requested = True
-                        sys.stdout.write(str(self.pdos))
-                        sys.stdout.write('\n')
-                    elif msg_name in ["Accept", "PS_RDY"]:
-                        self.process_accept_cb(d)
-                    elif msg_name == "Vendor_Defined":
-                        self.parse_vdm(d)
-                        self.react_vdm(d)
-                    self.show_msg(d)
-                    for message in self.sent_messages:
-                        sys.stdout.write('> ')
-                        sys.stdout.write(myhex(message))
-                        sys.stdout.write('\n')
-                    self.sent_messages = []
-                sleep(timeout) # so that ctrlc works
-                if self.fusb.int_p.value() == 0:
-                    # needs sink detach processing here lmao
-                    i = self.fusb.interrupts()
-                    print(i)
-                    i_reg = i[2]
-                    if i_reg & 0x80: # I_VBUSOK
-                        pass # just a side effect of vbus being attached
-                    if i_reg & 0x40: # I_ACTIVITY
-                        print("I_ACTIVITY")
-                        pass # just a side effect of CC comms I think?
-                    if i_reg & 0x20: # I_COMP_CHNG
-                        print("I_COMP_CHNG")
-                        cc = self.fusb.find_cc(fn="measure_sink")
-                        if cc == 0:
-                            print("Disconnect detected!")
-                            return # we exiting this
-                    if i_reg & 0x10: # I_CRC_CHK
-                        pass # new CRC, just a side effect of CC comms
-                    if i_reg & 0x8: # I_ALERT
-                        print("I_ALERT")
-                    if i_reg & 0x4: # I_WAKE
-                        print("I_WAKE")
-                    if i_reg & 0x2: # I_COLLISION
-                        print("I_COLLISION")
-                    if i_reg & 0x1: # I_BC_LVL
-                        print("I_BC_LVL")
+                    self.sink_message(d)
+                    self.print_sent()
+                    rx = self.rx_pending()
+                self.wait(timeout) # so that ctrlc works
+                if i is not None and self.sink_interrupts(i):
+                    return # we exiting this
         except KeyboardInterrupt:
             print("CtrlC")
             sleep(1)
             raise
 
+    def sink_message(self, d):
+        # now we do things depending on the message type that we received
+        self.sink_table[d.k](d)
+        self.show_msg(d)
+
+    def sink_source_caps(self, d):
+        # need to request a PDO!
+        self.pdos = d.pdos
+        pdo_i, current = self.select_pdo_cached(d)
+        # sending a message, need to increment message id
+        self.request_fixed_pdo(pdo_i, current, current)
+        # print("PDO requested!")
+        self.pdo_requested = True
+        sys.stdout.write(str(self.pdos))
+        sys.stdout.write('\n')
+
+    def sink_accept(self, d):
+        self.process_accept_cb(d)
+
+    def sink_interrupts(self, i):
+        # returns True if the source has been disconnected
+        # needs sink detach processing here lmao
+        print(i)
+        i_reg = i[2]
+        if i_reg & 0x80: # I_VBUSOK
+            pass # just a side effect of vbus being attached
+        if i_reg & 0x40: # I_ACTIVITY
+            print("I_ACTIVITY")
+            pass # just a side effect of CC comms I think?
+        if i_reg & 0x20: # I_COMP_CHNG
+            print("I_COMP_CHNG")
+            cc = self.fusb.find_cc(fn="measure_sink")
+            if cc == 0:
+                print("Disconnect detected!")
+                return True
+        if i_reg & 0x10: # I_CRC_CHK
+            pass # new CRC, just a side effect of CC comms
+        if i_reg & 0x8: # I_ALERT
+            print("I_ALERT")
+        if i_reg & 0x4: # I_WAKE
+            print("I_WAKE")
+        if i_reg & 0x2: # I_COLLISION
+            print("I_COLLISION")
+        if i_reg & 0x1: # I_BC_LVL
+            print("I_BC_LVL")
+        return False
+
+    def print_sent(self):
+        # messages we've sent out get printed once we're not in a hurry
+        for message in self.sent_messages:
+            sys.stdout.write('> ')
+            sys.stdout.write(myhex(message))
+            sys.stdout.write('\n')
+        self.sent_messages.clear()
+
     ########################
     #
     # Packet reception
@@ -270,96 +655,95 @@ class PDStacc():
 
     header_starts = [0xe0, 0xc0]
 
-    def get_message(self, get_rxb="get_rxb"):
+    vdm_key = message_keys["Vendor_Defined"]
+    source_caps_key = message_keys["Source_Capabilities"]
+
+    # whether get_message() checks received CRCs, and how many it found to be wrong
+    check_crc = True
+    crc_errors = 0
+    # bytes get_message() had to skip to find a message start, and whether it prints them
+    discarded = 0
+    show_discarded = True
+
+    def get_message(self, get_rxb=None):
+        if get_rxb is None:
+            get_rxb = self.rxb_fn
         if isinstance(get_rxb, str):
             get_rxb = getattr(self.fusb, get_rxb)
         header = 0
-        d = {}
         # we might have to get through some message data!
         while header not in self.header_starts:
             header = get_rxb(1)[0]
             if header == 0:
+                # FIFO is empty, so whatever's left in the burst buffer is padding
+                self.fusb.drop_rxb()
                 return
             if header not in self.header_starts:
-                # this will be printed, eventually.
-                # the aim is that it doesn't delay code in the way that print() seems to
-                sys.stdout.write("disc {}\n".format(hex(header)))
-        d["o"] = False # incoming message
-        d["h"] = header
+                self.discarded += 1
+                if self.show_discarded:
+                    # this will be printed, eventually.
+                    # the aim is that it doesn't delay code in the way that print() seems to
+                    sys.stdout.write("disc {}\n".format(hex(header)))
         b1, b0 = get_rxb(2)
-        d["b0"] = b0
-        d["b1"] = b1
-        sop = 1 if header == 0xe0 else 0
-        d["st"] = sop
-        # parsing the packet header
-        prole = b0 & 1
-        d["pr"] = prole
-        drole = b1 >> 5 & 1
-        d["dr"] = drole
-        msg_type = b1 & 0b11111
+        # only the header gets decoded here, the rest is done on demand
+        d = PDMessage(header, b1, b0, self)
         pdo_count = (b0 >> 4) & 0b111
-        d["dc"] = pdo_count
-        d["t"] = msg_type
-        d["c"] = pdo_count == 0 # control if True else data
-        msg_index = int((b0 >> 1) & 0b111)
-        d["i"] = msg_index
         if pdo_count:
             read_len = pdo_count*4
-            pdos = get_rxb(read_len)
-            d["d"] = pdos
-        _ = get_rxb(4) # crc
-        rev = b1 >> 6
-        d["r"] = rev
-        is_ext = b0 >> 7 # extended
-        d["e"] = is_ext
-        msg_types = control_message_types if pdo_count == 0 else data_message_types
-        msg_name = msg_types[d["t"]]
-        d["tn"] = msg_name
-        if msg_name == "Vendor_Defined":
-            self.parse_vdm(d)
+            d.d = get_rxb(read_len)
+        c = get_rxb(4)
+        if self.check_crc:
+            crc = crc32(bytes((b1, b0)))
+            if pdo_count:
+                crc = crc32(d.d, crc)
+            d.crc_ok = crc == c[0] | (c[1] << 8) | (c[2] << 16) | (c[3] << 24)
+            if not d.crc_ok:
+                self.crc_errors += 1
         return d
 
     def show_msg(self, d):
         ## d["h"] = header
         ## sop = 1 if header == 0xe0 else 0
         ## d["st"] = sop
-        sop_str = "" if d["st"] else "'"
+        sop_str = "" if d.st else "'"
         # parsing the packet header
         ## d["pr"] = prole
-        prole_str = "NC"[d["pr"]] if d["st"] else "R"
-        drole_str = "UD"[d["dr"]] if d["st"] else "R"
+        prole_str = "NC"[d.pr] if d.st else "R"
+        drole_str = "UD"[d.dr] if d.st else "R"
         ## d["dc"] = pdo_count
         ## d["t"] = msg_type
         ## d["c"] = pdo_count == 0 # control if True else data
-        message_types = control_message_types if d["c"]  else data_message_types
         ## d["i"] = msg_index
-        msg_type_str = message_types[d["t"]] if d["t"] < len(message_types) else "Reserved"
+        k = d.k
+        msg_type_str = message_names[k]
         ## if pdo_count:
         ##    d["d"] = pdos
         ## d["r"] = rev
-        rev_str = "123"[d["r"]]
+        rev_str = "123"[d.r]
         ## d["e"] = is_ext
-        ext_str = ["std", "ext"][d["e"]]
+        ext_str = ["std", "ext"][d.e]
         # msg direction
-        dir_str = ">" if d["o"] else "<"
-        if d["dc"]:
+        dir_str = ">" if d.o else "<"
+        if d.dc:
             # converting "41 80 00 FF A4 25 00 2C" to "FF008041 2C0025A4"
             pdo_strs = []
-            pdo_data = myhex(d["d"]).split(' ')
+            pdo_data = myhex(d.d).split(' ')
             for i in range(len(pdo_data)//4):
                 pdo_strs.append(''.join(reversed(pdo_data[(i*4):][:4])))
             pdo_str = " ".join(pdo_strs)
         else:
             pdo_str = ""
-        sys.stdout.write("{} {}{}: {}; p{} d{} r{}, {}, p{}, {} {}\n".format(dir_str, d["i"], sop_str, msg_type_str, prole_str, drole_str, rev_str, ext_str, d["dc"], myhex((d["b0"], d["b1"])).replace(' ', ''), pdo_str))
+        sys.stdout.write("{} {}{}: {}; p{} d{} r{}, {}, p{}, {} {}\n".format(dir_str, d.i, sop_str, msg_type_str, prole_str, drole_str, rev_str, ext_str, d.dc, myhex((d.b0, d.b1)).replace(' ', ''), pdo_str))
         # extra parsing where possible
-        if msg_type_str == "Vendor_Defined":
+        if k == self.vdm_key:
             self.print_vdm(d)
-            #sys.stdout.write(str(d["d"]))
+            #sys.stdout.write(str(d.d))
             #sys.stdout.write('\n')
-        elif msg_type_str == "Source_Capabilities":
-            sys.stdout.write(str(self.get_pdos(d)))
+        elif k == self.source_caps_key:
+            sys.stdout.write(str(d.pdos))
             sys.stdout.write('\n')
+        if d.crc_ok is False:
+            sys.stdout.write("CRC error\n")
         return d
 
     ########################
@@ -448,15 +832,40 @@ class PDStacc():
         return pdo
 
     def get_pdos(self, d):
+        # sources re-send the same capabilities a lot, so decoded PDOs are kept around.
+        # the returned list is shared between those messages, don't modify it
+        return self.caps_entry(d)[0]
+
+    def caps_entry(self, d):
+        key = bytes(d.d)
+        entry = self.caps_cache.get(key)
+        if entry is None:
+            entry = [self.decode_pdos(d), None, None]
+            self.caps_cache.put(key, entry)
+        return entry
+
+    def decode_pdos(self, d):
         pdo_list = []
-        pdos = d["d"]
-        for pdo_i in range(d["dc"]):
+        pdos = d.d
+        for pdo_i in range(d.dc):
             pdo_bytes = pdos[(pdo_i*4):][:4]
             #print(myhex(pdo_bytes))
             parsed_pdo = self.parse_capability_pdo(pdo_bytes)
             pdo_list.append(parsed_pdo)
         return pdo_list
 
+    def select_pdo_cached(self, d):
+        # select_pdo() result for a Source_Capabilities message. unless pure_select_pdo is set,
+        # the policy runs every time; with it set, it only runs again if the capabilities
+        # or select_pdo itself change
+        entry = self.caps_entry(d)
+        if not self.pure_select_pdo:
+            return self.select_pdo(entry[0])
+        if entry[2] is None or entry[2] != self.select_pdo:
+            entry[1] = self.select_pdo(entry[0])
+            entry[2] = self.select_pdo
+        return entry[1]
+
     ########################
     #
     # Command sending code
@@ -480,7 +889,7 @@ class PDStacc():
         header[1] |= (msg_id & 0b111) << 1 # message ID
         header[1] |= obj_count << 4
 
-        message = header+data
+        message = bytes(header)+bytes(data)
 
         self.fusb.send(message)
 
@@ -502,8 +911,15 @@ class PDStacc():
         self.send_command(0b1, data, power_role=1, data_role=1)
 
     def process_psu_request(self, d):
+        if not self.accept_psu_request(d):
+            return False
+        sleep(0.1)
+        self.send_ps_rdy()
+
+    def accept_psu_request(self, d):
+        # validates the request, sends Accept and switches the power rail over
         print(d)
-        profile = ((d["d"][3] >> 4)&0b111)-1
+        profile = ((d.d[3] >> 4)&0b111)-1
         print("Selected profile", profile)
         if not self.validate_profile_cb(profile, d):
             print("Profile", profile, "not handled!")
@@ -512,7 +928,9 @@ class PDStacc():
         self.send_command(0b11, [], power_role=1, data_role=1) # Accept
         # external callback
         self.switch_to_profile_cb(profile, d)
-        sleep(0.1)
+        return True
+
+    def send_ps_rdy(self):
         self.send_command(0b110, [], power_role=1, data_role=1) # PS_RDY
 
     ########################
@@ -566,6 +984,23 @@ class PDStacc():
                 #print(get_message())
             sleep(0.0001)
 
+    def flow_capture(self, writer, cc=0):
+        # like flow_record, except that the raw FIFO contents get streamed
+        # through a capture.CaptureWriter, with timestamps
+        buf = bytearray(80)
+        try:
+            while True:
+                if self.fusb.rxb_state()[0] == 0:
+                    ts = ticks_us()
+                    l = self.get_buffer_into(buf)
+                    writer.record(memoryview(buf)[:l], cc, ts)
+                else:
+                    # writes out full capture buffers and keeps the capture clock going
+                    writer.idle()
+                sleep(0.0001)
+        finally:
+            writer.flush()
+
     def get_buffer_fast(self, packets):
         packet = []
         while self.fusb.rxb_state()[0] == 0:
@@ -573,6 +1008,14 @@ class PDStacc():
         packets.append(packet)
         return packet
 
+    def get_buffer_into(self, buf):
+        # same as get_buffer_fast, but reads into a preallocated buffer, returns the length read
+        l = 0
+        while l < len(buf) and self.fusb.rxb_state()[0] == 0:
+            buf[l] = self.fusb.get_rxb(1)[0]
+            l += 1
+        return l
+
     ########################
     #
     # VDM parsing and response code
@@ -601,63 +1044,42 @@ class PDStacc():
 
     # reply-with-hardcoded code
 
-    def react_vdm(self, d):
-        if d["vdm_s"]:
-            cmd_type = d["vdm_ct"]
-            command_name = d["vdm_cn"]
-            # response vdm params
-            rd = {}
-            # all same params as the incoming message, save for the command type
-            for key in ["vdm_s", "vdm_sv", "vdm_c", "vdm_v", "vdm_o"]:
-                rd[key] = d[key]
+    # data objects following the VDM header for each reply we send, by (SVID, command).
+    # replies get fully encoded once, in build_vdm_replies()
+    vdm_reply_data = {
+        # discover identity response with "we are an altmode adapter yesyes"
+        (0xff00, 1): b'\xa4%\x00,\x00\x00\x00\x00\x01\x00\x00\x00\x0b\x00\x00\x11', # Discover Identity
+        (0xff00, 2): b'\x00\x00\x01\xff', # Discover SVIDs
+        #(0xff01, 3): b'\x45\x04\x00\x00', # Discover Modes
+        (0xff01, 3): b'\x05\x0c\x00\x00', # Discover Modes
+        (0xff01, 4): b'', # Enter Mode
+        #(0xff01, 0x10): b'\x1a\x00\x00\x00', # DP Status Update
+        (0xff01, 0x10): b'\x9a\x00\x00\x00', # DP Status Update
+        (0xff01, 0x11): b'', # DP Configure
+    }
+
+    def build_vdm_replies(self):
+        self.vdm_replies = {}
+        for (svid, command), data in self.vdm_reply_data.items():
             # command type is ACK and not REQ for all command replies
-            rd["vdm_ct"] = 1 # ACK
-            if command_name == "Discover Identity":
-                # discover identity response with "we are an altmode adapter yesyes"
-                data = list(b'A\xA0\x00\xff\xa4%\x00,\x00\x00\x00\x00\x01\x00\x00\x00\x0b\x00\x00\x11')
-                r = self.create_vdm_data(rd, data[4:])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("a") # debug stuff
-            elif command_name == "Discover SVIDs":
-                data = list(b'B\xA0\x00\xff\x00\x00\x01\xff')
-                r = self.create_vdm_data(rd, data[4:])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("b")
-            elif command_name == "Discover Modes":
-                #data = list(b'C\xA0\x01\xff\x45\x04\x00\x00')
-                data = list(b'C\xA0\x01\xff\x05\x0c\x00\x00')
-                r = self.create_vdm_data(rd, data[4:])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("c")
-            elif command_name == "Enter Mode":
-                data = list(b'D\xA1\x01\xff')
-                r = self.create_vdm_data(rd, [])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("d")
-            elif command_name == "DP Status Update":
-                #data = list(b'P\xA1\x01\xff\x1a\x00\x00\x00')
-                data = list(b'P\xA1\x01\xff\x9a\x00\x00\x00')
-                r = self.create_vdm_data(rd, data[4:])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("e")
-            elif command_name == "DP Configure":
-                data = list(b'Q\xA1\x01\xff')
-                r = self.create_vdm_data(rd, [])
-                print(r)
-                print(data)
-                self.send_command(d["t"], r)
-                #sys.stdout.write("f")
-        # no unstructured vdm processing at this time
+            rd = {"vdm_s": 1, "vdm_sv": svid, "vdm_c": command, "vdm_ct": 1}
+            self.vdm_replies[(svid, command)] = self.create_vdm_data(rd, data)
+
+    def react_vdm(self, d):
+        # works on the raw data objects, so that none of the VDM fields need decoding
+        data = d.d
+        if not data[1] & 0x80:
+            return # no unstructured vdm processing at this time
+        if data[0] >> 6:
+            return # only requests get replies
+        svid = (data[3] << 8) | data[2]
+        r = self.vdm_replies.get((svid, data[0] & 0b11111), None)
+        if r is None:
+            return
+        r = bytearray(r)
+        # version and object position are the same as in the incoming message
+        r[1] = (r[1] & 0x80) | (data[1] & 0x7f)
+        self.send_command(d.t, r)
 
     def create_vdm_data(self, d, data):
         """
@@ -665,8 +1087,8 @@ class PDStacc():
         """
         l = 4 + len(data)
         vdm = bytearray(l)
-        for i in data:
-            vdm[i+4] = i
+        for i, b in enumerate(data):
+            vdm[i+4] = b
         # most basic vdm flags
         vdm_s = d["vdm_s"]
         vdm[1] |= vdm_s << 7
@@ -693,35 +1115,35 @@ class PDStacc():
         return bytes(vdm)
 
     def parse_vdm(self, d):
-        data = d['d']
+        data = d.d
         is_structured = data[1] >> 7
-        d["vdm_s"] = is_structured
+        d.vdm_s = is_structured
         svid = (data[3] << 8) + data[2]
-        d["vdm_sv"] = svid
+        d.vdm_sv = svid
         svid_name = self.svids.get(svid, "Unknown ({})".format(hex(svid)))
-        d["vdm_svn"] = svid_name
+        d.vdm_svn = svid_name
         if is_structured:
             # version: major and minor
             version_bin = (data[1] >> 3) & 0xf
-            d["vdm_v"] = version_bin
+            d.vdm_v = version_bin
             obj_pos = data[1] & 0b111
-            d["vdm_o"] = obj_pos
+            d.vdm_o = obj_pos
             cmd_type = data[0]>>6
-            d["vdm_ct"] = cmd_type
+            d.vdm_ct = cmd_type
             command = data[0] & 0b11111
-            d["vdm_c"] = command
+            d.vdm_c = command
             if command > 15:
                 command_name = "SVID specific {}".format(bin(command))
                 if svid_name == "DisplayPort":
                     command_name = self.dp_commands.get(command, command_name)
             else:
                 command_name = self.vdm_commands[command] if command < 7 else "Reserved"
-            d["vdm_cn"] = command_name
+            d.vdm_cn = command_name
             #if svid_name == "DisplayPort":
             #    parse_dp_command(version_str())
         else:
             vdmd = [data[1] & 0x7f, data[0]]
-            d["vdm_d"] = vdmd
+            d.vdm_d = vdmd
         #print(d)
 
     vdm_dp_pin_assg = {
@@ -762,16 +1184,16 @@ class PDStacc():
     }
 
     def print_vdm(self, d):
-        if d["vdm_s"]:
-            svid_name = d["vdm_svn"]
-            version_str = mybin([d["vdm_v"]])[4:]
-            objpos_str = mybin([d["vdm_o"]])[5:]
-            cmd_type_name = self.vdm_cmd_types[d["vdm_ct"]]
-            cmd_name = d["vdm_cn"]
+        if d.vdm_s:
+            svid_name = d.vdm_svn
+            version_str = mybin([d.vdm_v])[4:]
+            objpos_str = mybin([d.vdm_o])[5:]
+            cmd_type_name = self.vdm_cmd_types[d.vdm_ct]
+            cmd_name = d.vdm_cn
             sys.stdout.write("VDM: str, m{} v{} o{}, ct{}: {}\n".format(svid_name, version_str, objpos_str, cmd_type_name, cmd_name))
             if svid_name == "DisplayPort":
                 if cmd_name == "Discover Modes" and cmd_type_name == "ACK":
-                    msg = d['d'][4:]
+                    msg = d.d[4:]
                     # port capability (bits 0:1)
                     port_cap = msg[0] & 0b11
                     vdm_dp_port_cap_s = self.vdm_dp_port_cap[port_cap]
@@ -803,7 +1225,7 @@ class PDStacc():
                     #res_byte = msg[3] # (bites 31:24, has to be 0)
                     sys.stdout.write("\tModes: p_cap:{} sgn:{} ri:{} u2:{} d_ass:{} u_ass:{}\n".format(vdm_dp_port_cap_s, sgn_s, r_s, u2_s, dfp_assy_s, ufp_assy_s))
                 elif cmd_name == "DP Status Update":
-                    msg = d['d'][4:]
+                    msg = d.d[4:]
                     # dfp/ufp connected (bits 0:1)
                     conn = msg[0] & 0b11
                     conn_s = self.vdm_dp_port_conn[conn]
@@ -830,7 +1252,7 @@ class PDStacc():
                     irq_s = str(irq)
                     sys.stdout.write("\tStatus: conn:{} pwr:{} en:{} mf:{} usw:{} dpe:{} hpd:{} irq:{}\n".format(conn_s, pwr_s, en_s, mf_s, usw_s, dpe_s, hpd_s, irq_s))
                 if cmd_name == "DP Configure" and cmd_type_name == "REQ":
-                    msg = d['d'][4:]
+                    msg = d.d[4:]
                     # select configuration (bits 0:1)
                     conf = msg[0] & 0b11
                     conf_s = self.vdm_dp_port_conf[conf]
@@ -855,7 +1277,7 @@ class PDStacc():
                 #di = d
                 #breakpoint()
         else:
-            sys.stdout.write("VDM: unstr, m{}, d{}".format(svid_name, myhex(d["vdm_d"])))
+            sys.stdout.write("VDM: unstr, m{}, d{}".format(svid_name, myhex(d.vdm_d)))
 
 ########################
 #
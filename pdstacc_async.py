@@ -0,0 +1,175 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from pdstacc import PDStacc, message_keys
+from compat import ticks_ms, ticks_diff
+
+########################
+#
+# asyncio flavour of the stacc
+#
+########################
+
+class AsyncPDStacc(PDStacc):
+    # same stack, except every step that used to sleep() now yields to other tasks instead,
+    # so that things like displays and ADC polling can run alongside PD negotiation.
+    # runs under both uasyncio and asyncio
+
+    # get_message() and send_command() stay blocking: machine.I2C has no awaitable transfers,
+    # and a FIFO read or write is a single bus transaction with nothing to wait for in between.
+    # the flows yield after every message instead
+
+    # how long the flows yield between FUSB checks, in seconds
+    poll_interval = 0.001
+    # in irq mode, the longest the flows wait for int_p before checking on things anyway, in seconds
+    irq_timeout = 0.1
+
+    # messages that get a coroutine handler, by message name; everything else goes through
+    # the regular handler tables. the coroutines have their own names, so that the sync tables
+    # built by PDStacc.__init__() (and anything else calling react_vdm() and friends) get the sync methods
+    async_sink_handlers = {
+        "Vendor_Defined": "react_vdm_async",
+    }
+    async_source_handlers = {
+        "Request": "source_request_async",
+    }
+
+    def __init__(self, *args, **kwargs):
+        PDStacc.__init__(self, *args, **kwargs)
+        self.async_sink_table = self.async_handler_table(self.async_sink_handlers)
+        self.async_source_table = self.async_handler_table(self.async_source_handlers)
+        # uasyncio can wake a task up straight from an IRQ handler; asyncio can't, and keeps polling
+        self.int_event = None
+        if self.irq_mode and hasattr(asyncio, "ThreadSafeFlag"):
+            self.int_event = asyncio.ThreadSafeFlag()
+            self.fusb.int_p.irq(self.int_cb, trigger=self.fusb.int_p.IRQ_FALLING)
+
+    def int_cb(self, pin):
+        self.fusb.int_cb(pin)
+        self.int_event.set()
+
+    async def wait_async(self):
+        # yields to other tasks until the next FUSB check; in irq mode, until int_p fires
+        if self.int_event is None or self.fusb.int_flag or self.fusb.rx_buffered():
+            await asyncio.sleep(self.poll_interval)
+            return
+        try:
+            await asyncio.wait_for(self.int_event.wait(), self.irq_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def async_handler_table(self, handlers):
+        # like handler_table(), with None for messages that don't have a coroutine handler
+        table = [None]*64
+        for name, fn in handlers.items():
+            table[message_keys[name]] = getattr(self, fn)
+        return table
+
+    async def find_cc(self, fn):
+        cc = self.fusb.find_cc(fn=fn, debug=True)
+        while cc == 0:
+            await asyncio.sleep(self.poll_interval)
+            cc = self.fusb.find_cc(fn=fn)
+        cc = self.fusb.find_cc(fn=fn, debug=True)
+        return cc
+
+    async def setup_sink(self):
+        self.configure_sink()
+        self.cc = await self.find_cc("measure_sink")
+
+    async def setup_listen(self, cc):
+        self.fusb.flush_receive()
+        self.fusb.disable_pulldowns()
+        await asyncio.sleep(0.2)
+        self.fusb.read_cc(cc)
+        self.fusb.enable_sop()
+        self.fusb.flush_transmit()
+        self.fusb.flush_receive()
+        self.fusb.reset_pd()
+
+    async def setup_source(self):
+        self.configure_source()
+        self.cc = await self.find_cc("measure_source")
+        self.set_5v_power_rail_cb()
+
+    async def flow_sink(self):
+        self.pdo_requested = False
+        self.reset_msg_id()
+        while True:
+            rx, i = self.poll()
+            while rx:
+                d = self.get_message()
+                if d is None: # only padding was left, get_message() dropped it
+                    break
+                self.packets.append(d)
+                await self.sink_message_async(d)
+                self.print_sent()
+                rx = self.rx_pending()
+                await asyncio.sleep(0)
+            if i is not None and self.sink_interrupts(i):
+                return
+            await self.wait_async()
+
+    async def sink_message_async(self, d):
+        handler = self.async_sink_table[d.k]
+        if handler is None:
+            # nothing in the sync handlers blocks
+            self.sink_message(d)
+            return
+        await handler(d)
+        self.show_msg(d)
+
+    async def flow_source(self, psu_advertisement):
+        advertisement_counter = 1
+        self.reset_msg_id()
+        await asyncio.sleep(0.3)
+        print("sending advertisement")
+        self.send_advertisement(psu_advertisement)
+        advertised = ticks_ms()
+        self.profile_selected = False
+        while True:
+            rx, i = self.poll()
+            while rx:
+                d = self.get_message()
+                if d is None: # only padding was left, get_message() dropped it
+                    break
+                self.packets.append(d)
+                await self.source_message_async(d)
+                rx = self.rx_pending()
+                await asyncio.sleep(0)
+            self.print_sent()
+            if ticks_diff(ticks_ms(), advertised) >= self.advertisement_interval * 1000:
+                advertised = ticks_ms()
+                if not self.profile_selected and advertisement_counter < 30:
+                    print("sending advertisement")
+                    self.send_advertisement(psu_advertisement)
+                    advertisement_counter += 1
+            if i is not None and self.source_interrupts(i):
+                return
+            await self.wait_async()
+
+    async def source_message_async(self, d):
+        handler = self.async_source_table[d.k]
+        if handler is None:
+            self.source_message(d)
+            return
+        await handler(d)
+        self.show_msg(d)
+
+    async def source_request_async(self, d):
+        self.profile_selected = True
+        await self.process_psu_request_async(d)
+
+    async def process_psu_request_async(self, d):
+        if not self.accept_psu_request(d):
+            return False
+        # the rail is switching over, other tasks can run in the meantime
+        await asyncio.sleep(0.1)
+        self.send_ps_rdy()
+
+    async def react_vdm_async(self, d):
+        self.react_vdm(d)
+        # give other tasks a go once the reply is out
+        await asyncio.sleep(0)
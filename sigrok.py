@@ -0,0 +1,143 @@
+# Reads sigrok/PulseView .sr sessions and decodes I2C from the logic samples directly,
+# without having to export decoder annotations as text first.
+# Needs NumPy:
+#
+#     from sigrok import load_sr, decode_i2c
+#     samples, samplerate, probes = load_sr("captures/pinecil_1.sr")
+#     for t in decode_i2c(samples, probes["D0"], probes["D1"]):
+#         print(t)
+#
+# decode_i2c() yields the same transaction token lists that captures/trace.py assembles from text exports.
+
+import zipfile
+
+import numpy as np
+
+########################
+#
+# .sr session loading
+#
+########################
+
+si_prefixes = {"": 1, "k": 10**3, "M": 10**6, "G": 10**9}
+
+def parse_samplerate(s):
+    # "3 MHz" -> 3000000
+    value, unit = s.split(' ', 1)
+    return int(float(value) * si_prefixes[unit[:-2]])
+
+def parse_metadata(text):
+    # the metadata file is ini-style; only the first device is looked at, since that's all PulseView saves
+    meta = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line.strip('[]')
+        elif '=' in line and section == "device 1":
+            key, value = line.split('=', 1)
+            meta[key] = value
+    return meta
+
+def load_sr(path):
+    # returns (samples, samplerate, probes), with samples being a NumPy array with one element per sample,
+    # and probes being a dict of probe name -> bit number within a sample
+    with zipfile.ZipFile(path) as z:
+        meta = parse_metadata(z.read("metadata").decode())
+        samplerate = parse_samplerate(meta["samplerate"])
+        unitsize = int(meta.get("unitsize", 1))
+        probes = {}
+        for key, value in meta.items():
+            if key.startswith("probe") and key[5:].isdigit():
+                probes[value] = int(key[5:]) - 1
+        # sample data is split into chunks: logic-1-1, logic-1-2, ...
+        capturefile = meta.get("capturefile", "logic-1")
+        chunks = [name for name in z.namelist() if name == capturefile or name.startswith(capturefile+"-")]
+        chunks.sort(key=lambda name: int(name.rsplit('-', 1)[1]) if name != capturefile else 0)
+        data = b''.join([z.read(name) for name in chunks])
+    dtype = {1: np.uint8, 2: np.dtype("<u2"), 4: np.dtype("<u4"), 8: np.dtype("<u8")}[unitsize]
+    samples = np.frombuffer(data, dtype=dtype)
+    return samples, samplerate, probes
+
+########################
+#
+# I2C decoding
+#
+########################
+
+def i2c_symbols(samples, scl_bit, sda_bit):
+    # finds START/STOP conditions and clocked-in bits, without looping over samples in Python.
+    # returns (positions, symbols): sample indices and symbols, 0/1 for bits, 2 for START, 3 for STOP
+    lines = ((samples >> scl_bit) & 1) | (((samples >> sda_bit) & 1) << 1)
+    lines = lines.astype(np.int8)
+    # only the samples where either line changes matter
+    changes = np.flatnonzero(np.diff(lines)) + 1
+    cur = lines[changes]
+    prev = lines[changes - 1]
+    scl_prev = prev & 1
+    scl_cur = cur & 1
+    sda_prev = prev >> 1
+    sda_cur = cur >> 1
+    scl_high = (scl_prev == 1) & (scl_cur == 1)
+    start = scl_high & (sda_prev == 1) & (sda_cur == 0)
+    stop = scl_high & (sda_prev == 0) & (sda_cur == 1)
+    # SDA is sampled on the rising SCL edge
+    bit = (scl_prev == 0) & (scl_cur == 1)
+    keep = start | stop | bit
+    symbols = np.where(start, 2, np.where(stop, 3, sda_cur))[keep]
+    return changes[keep], symbols
+
+bit_weights = np.array([128, 64, 32, 16, 8, 4, 2, 1], dtype=np.int32)
+
+def frame_bytes(bits):
+    # bits clocked in between two conditions -> (bytes, ACK bits), 9 bits per byte.
+    # a trailing partial byte (bus glitch, truncated capture) is dropped
+    n = len(bits) // 9
+    frame = bits[:n*9].reshape(n, 9)
+    return (frame[:, :8] @ bit_weights).tolist(), frame[:, 8].tolist()
+
+def decode_i2c(samples, scl_bit, sda_bit, addrs=None):
+    # yields transactions as token lists, same as captures/trace.py's assemble():
+    # ["start", addr, 'wr', 'ack', 'wr', reg, 'ack', 'start repeat', addr, 'rd', 'ack', 'rd', data, 'nack', 'stop']
+    # transactions for addresses not in `addrs` are skipped
+    positions, symbols = i2c_symbols(samples, scl_bit, sda_bit)
+    # conditions split the bit stream into frames; the Python loop only runs once per frame
+    conditions = np.flatnonzero(symbols >= 2)
+    t = None
+    skip = False
+    for i, c in enumerate(conditions.tolist()):
+        if symbols[c] == 3:
+            if t is not None and not skip:
+                t.append('stop')
+                yield t
+            t = None
+            continue
+        # START, or a repeated START if there was no STOP since the last one
+        if t is None:
+            t = ["start"]
+            skip = False
+        elif not skip:
+            t.append('start repeat')
+        end = conditions[i+1] if i+1 < len(conditions) else len(symbols)
+        values, acks = frame_bytes(symbols[c+1:end])
+        if not values or skip:
+            continue
+        addr = values[0] >> 1
+        rw = 'rd' if values[0] & 1 else 'wr'
+        if len(t) == 1 and addrs is not None and addr not in addrs:
+            skip = True
+            continue
+        t.append(addr)
+        t.append(rw)
+        t.append('nack' if acks[0] else 'ack')
+        for value, ack in zip(values[1:], acks[1:]):
+            t.append(rw)
+            t.append(value)
+            t.append('nack' if ack else 'ack')
+    if t is not None and not skip:
+        yield t
+
+def load_i2c(path, scl="D0", sda="D1", addrs=None):
+    # decodes I2C transactions straight from an .sr file, with SCL and SDA given by probe name
+    samples, samplerate, probes = load_sr(path)
+    return decode_i2c(samples, probes[scl], probes[sda], addrs)
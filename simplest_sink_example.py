@@ -3,6 +3,7 @@ from time import sleep
 
 from fusb302 import FUSB302
 from pdstacc import PDStacc
+from pdsm import SinkStateMachine
 
 ########################
 #
@@ -81,13 +82,12 @@ stacc.select_pdo = select_pdo_for_voltage
 ########################
 
 stacc.init_fusb()
+# the state machine goes back to waiting for a source after unplug,
+# see pdsm.py for the state tables
+sm = SinkStateMachine(stacc)
 while True:
     try:
-        stacc.setup_sink()
-        stacc.flow_sink()
-        # after flow_sink exits, setup_sink runs again
-        # this handles stack reset after unplug
-        # this would best work as an actual explicit state machine
+        sm.run()
     except KeyboardInterrupt:
         # lets you exit the loop on ctrlc
         print("CtrlC again to exit")
@@ -3,6 +3,7 @@ from time import sleep
 
 from fusb302 import FUSB302
 from pdstacc import PDStacc
+from capture import CaptureWriter, ReplaySource, RetryFilter
 
 ########################
 #
@@ -11,6 +12,10 @@ from pdstacc import PDStacc
 ########################
 
 replay = True
+# in live mode, stream timestamped packets into this file instead of keeping them in RAM
+capture_file = None # "capture.bin"
+# in replay, collapse hardware retries into one message with a retry count
+dedup = True
 
 i2c = I2C(sda=Pin(18), scl=Pin(19), id=1, freq=400000)
 print(i2c.scan())
@@ -38,63 +43,39 @@ packets5 = [[192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 65, 1, 45, 92,
 # framework hdmi card
 packets6 = [[192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 224, 161, 17, 44, 145, 1, 39, 177, 155, 38, 148, 224, 161, 17, 44, 145, 1, 39, 177, 155, 38, 148, 224, 161, 17, 44, 145, 1, 39, 177, 155, 38, 148, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8], [224, 161, 17, 44, 145, 1, 39, 177, 155, 38, 148, 224, 1, 0, 190, 35, 194, 88, 224, 130, 16, 68, 16, 129, 18, 170, 55, 43, 91, 224, 97, 1, 143, 120, 56, 74, 224, 163, 3, 111, 172, 250, 93, 224, 1, 2, 146, 66, 204, 182], [224, 166, 5, 31, 253, 238, 201, 224, 1, 4, 167, 231, 175, 95], [192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135], [192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253], [192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66, 192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66, 192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66], [192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56, 192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56, 192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56], [192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183, 192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183, 192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183], [192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205, 192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205, 192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205], [192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114], [192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8], [192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135], [192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253], [192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66, 192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66, 192, 143, 24, 1, 160, 0, 255, 101, 14, 114, 66], [192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56, 192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56, 192, 143, 26, 1, 160, 0, 255, 5, 93, 178, 56], [192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183, 192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183, 192, 143, 28, 1, 160, 0, 255, 165, 168, 242, 183], [192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205, 192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205, 192, 143, 30, 1, 160, 0, 255, 197, 251, 50, 205], [192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114, 192, 143, 16, 1, 160, 0, 255, 164, 69, 2, 114], [192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8, 192, 143, 18, 1, 160, 0, 255, 196, 22, 194, 8], [192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135, 192, 143, 20, 1, 160, 0, 255, 100, 227, 130, 135], [192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253, 192, 143, 22, 1, 160, 0, 255, 4, 176, 66, 253], [224, 175, 23, 1, 160, 0, 255, 130, 156, 142, 199, 224, 1, 6, 139, 134, 161, 177, 224, 143, 82, 65, 160, 0, 255, 172, 50, 0, 108, 0, 0, 0, 0, 0, 0, 2, 0, 24, 0, 0, 0, 138, 93, 194, 80, 224, 97, 3, 163, 25, 54, 164, 224, 175, 25, 2, 160, 0, 255, 13, 141, 11, 106, 224, 1, 8, 140, 171, 25, 86, 224, 143, 36, 66, 160, 0, 255, 0, 0, 1, 255, 235, 230, 247, 249, 224, 97, 5, 150, 188, 85, 77, 224, 175, 27, 3, 160, 1, 255, 73, 136, 108, 177, 224, 1, 10, 160, 202, 23, 184, 224, 143, 38, 67, 160, 1, 255, 5, 4, 0, 0, 116, 155, 57, 212, 224, 97, 7, 186, 221, 91, 163, 224, 175, 29, 4, 161, 1, 255, 103, 47, 57, 162, 224, 1, 12, 149, 111, 116, 81, 224, 143, 24, 68, 161, 1, 255, 28, 253, 97, 246, 224, 175, 47, 16, 161, 1, 255, 1, 0, 0, 0, 229, 238, 114, 194, 224, 1, 14, 185, 14, 122, 191, 224, 175, 33, 17, 161, 1, 255, 6, 4, 0, 0, 140, 165, 196, 92, 224, 1, 0, 190, 35, 194, 88, 224, 143, 28, 81, 161, 1, 255, 113, 252, 38, 100, 224, 97, 13, 164, 52, 142, 67]]
 
-packets_pos = [ 0,0 ] # hoot-hoot,,, hewwo ;-P
+# replay source for postfactum_readout, set up when replaying
+source = None
 
 def gb():
     fun = postfactum_readout if replay else fusb.get_rxb
     return stacc.show_msg(stacc.get_message(fun))
 
+def show_retried(messages):
+    for d, retries, ts, cc in messages:
+        stacc.show_msg(d)
+        if retries:
+            print("({} retries)".format(retries))
+        print()
+
 def gba():
-    # not quite working well atm, sowwy (also, mood)
-    while True:
-      try:
-        gb(); print()
-      except IndexError:
-        return
-      except Exception as e:
-        raise e
-        break
+    # decodes and prints everything that's left in the replay source
+    retry_filter = RetryFilter() if dedup else None
+    while not source.done():
+        d = stacc.get_message(source.get_rxb)
+        if d is None:
+            continue
+        if retry_filter is None:
+            stacc.show_msg(d); print()
+        else:
+            show_retried(retry_filter.push(d))
+    if retry_filter is not None:
+        show_retried(retry_filter.flush())
+        print("{} messages, {} retries {}".format(retry_filter.messages, retry_filter.retries, retry_filter.retries_by_type))
 
 def postfactum_readout(length=80):
     # A function that helps read data out of our own capture buffer instead of using the FUSB's internal buffer
     # so, it pretends to be the FUSB FIFO read function, for parsing packets that are recorded into `packets`
-    err = 0
-    response = []
-    while len(response) < length:
-        # ran out of data? this ends here
-        if packets_pos[0] == len(packets)-1 and packets_pos[1] == len(packets[packets_pos[0]])-1:
-            # buffer underflow, returning the unfinished buffer with zeroes in the end, just like the FUSB does
-            response = [0]*(length-len(response))
-            return bytes(response)
-        # we still got data to add!
-        # is the current buffer enough?
-        remainder = length - len(response)
-        current_packet = packets[packets_pos[0]]
-        current_packet_end = current_packet[packets_pos[1]:]
-        while remainder > 0:
-            chunk_len = min(len(current_packet_end), remainder)
-            response += current_packet_end[:chunk_len]
-            remainder -= chunk_len
-            packets_pos[1] += chunk_len
-            # now, checking for overflow
-            if packets_pos[1] >= len(current_packet)-1:
-                # sanity check - this should not happen
-                if packets_pos[1] > len(current_packet):
-                    print("Alert, overcount!", packets_pos, len(current_packet_end), chunk_len)
-                # do we need to go to the next packet?
-                if len(packets)-1 <= packets_pos[0]:
-                    # next packet doesn't exist lol
-                    print("We ran out of packet")
-                    err += 1 # malformed packets cause this function to glitch and loop infinitely, hence the error counter
-                    if err == 4:
-                        return bytes(response) # lol gave up here
-                else:
-                    err = 0
-                    packets_pos[0] += 1
-                    packets_pos[1] = 0
-            current_packet = packets[packets_pos[0]]
-            current_packet_end = current_packet[packets_pos[1]:]
-        return bytes(response)
+    return source.get_rxb(length)
 
 ########################
 #
@@ -108,6 +89,10 @@ stacc.init_fusb()
 stacc.setup_listen(listen_cc)
 
 if not replay:
-    stacc.flow_record(packets=packets)
+    if capture_file:
+        with open(capture_file, "wb") as f:
+            stacc.flow_capture(CaptureWriter(f), cc=listen_cc)
+    else:
+        stacc.flow_record(packets)
 else:
-    packets = packets1; gba()
+    packets = packets1; source = ReplaySource(packets); gba()
@@ -3,6 +3,7 @@ from time import sleep
 
 from fusb302 import FUSB302
 from pdstacc import PDStacc
+from pdsm import SourceStateMachine
 
 ########################
 #
@@ -109,9 +110,13 @@ def switch_to_profile(profile, d):
 def en_5v_power_rail():
     set_power_rail('5V')
 
+def power_off():
+    set_power_rail('off')
+
 stacc.validate_profile_cb = validate_profile
 stacc.switch_to_profile_cb = switch_to_profile
-stacc.en_5v_power_rail_cb = en_5v_power_rail
+stacc.set_5v_power_rail_cb = en_5v_power_rail
+stacc.power_off_cb = power_off
 
 psu_advertisement = stacc.create_pdo('fixed', 5000, 1500, 0, 8) + \
                     stacc.create_pdo('fixed', 19000, 5000, 0, 0)
@@ -123,13 +128,12 @@ psu_advertisement = stacc.create_pdo('fixed', 5000, 1500, 0, 8) + \
 ########################
 
 stacc.init_fusb()
+# the state machine turns the rails off and goes back to waiting for a sink after unplug,
+# see pdsm.py for the state tables
+sm = SourceStateMachine(stacc, psu_advertisement)
 while True:
     try:
-        set_power_rail('off')
-        stacc.setup_source()
-        stacc.flow_source()
-        # after flow_source exits, setup_source runs again
-        # this would best work as an actual explicit state machine
+        sm.run()
     except KeyboardInterrupt:
         # lets you exit the loop on ctrlc
         print("CtrlC again to exit")